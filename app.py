@@ -5,116 +5,851 @@ import json
 import gspread
 from datetime import datetime
 from oauth2client.service_account import ServiceAccountCredentials
-import easyocr # Importar easyocr
 from PIL import Image # Importar Image do PIL
 import re # Importar re
 import io # Importar io
 import numpy as np # Importar numpy para easyocr
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+import random
+import requests
+import hashlib
+import sqlite3
+import itertools
+import functools
+from collections import deque
+from contextlib import contextmanager
+import pyarrow.feather as feather
 
 st.set_page_config(page_title="Consulta de Empréstimos", layout="wide")
 
+# As bases são compartilhadas entre sessões; com Copy-on-Write (padrão a partir do pandas 3)
+# nenhum recorte ou coluna derivada escreve de volta nelas
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# --- Instrumentação: tempo por etapa de cada rerun, chamadas ao Sheets por função e acertos de cache ---
+# Os números ficam em memória (compartilhados entre sessões) e aparecem na página Diagnóstico.
+# Com DIAGNOSTICO_LOG definido, cada evento também é gravado nesse arquivo em JSON Lines.
+class Instrumentacao:
+    MAX_EVENTOS = 5000
+
+    def __init__(self, arquivo_log=None):
+        self.arquivo_log = arquivo_log
+        self._lock = threading.Lock()
+        self._local = threading.local()  # rerun e operação do Sheets em andamento na thread
+        self.zerar()
+
+    def zerar(self):
+        with self._lock:
+            self.eventos = deque(maxlen=self.MAX_EVENTOS)
+            self.sheets = {}  # operação -> totais de chamadas, bytes e tempo
+            self.cache = {}  # função -> {"chamadas", "execucoes", "tempo_s", "ultima_execucao_s"}
+
+    def _registrar(self, tipo, **dados):
+        evento = {"tipo": tipo, "ts": datetime.now().isoformat(timespec="milliseconds"), **dados}
+        self.eventos.append(evento)
+        if self.arquivo_log:
+            with open(self.arquivo_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(evento, ensure_ascii=False) + "\n")
+
+    # Etapas do rerun: iniciar no topo do script, finalizar no fim; etapas podem ser abertas e fechadas
+    # em pontos diferentes do script ou medidas com o gerenciador de contexto etapa()
+    def iniciar_execucao(self):
+        self._local.execucao = {"inicio": time.perf_counter(), "etapas": {}, "abertas": {}, "calculadas": set()}
+
+    def abrir_etapa(self, nome):
+        execucao = getattr(self._local, "execucao", None)
+        if execucao is not None:
+            execucao["abertas"][nome] = time.perf_counter()
+
+    def fechar_etapa(self, nome):
+        execucao = getattr(self._local, "execucao", None)
+        if execucao is not None and nome in execucao["abertas"]:
+            duracao = time.perf_counter() - execucao["abertas"].pop(nome)
+            execucao["etapas"][nome] = execucao["etapas"].get(nome, 0.0) + duracao
+
+    @contextmanager
+    def etapa(self, nome):
+        self.abrir_etapa(nome)
+        try:
+            yield
+        finally:
+            self.fechar_etapa(nome)
+
+    def finalizar_execucao(self, pagina):
+        execucao = getattr(self._local, "execucao", None)
+        if execucao is None:
+            return
+        for nome in list(execucao["abertas"]):
+            self.fechar_etapa(nome)
+        self._local.execucao = None
+        total = time.perf_counter() - execucao["inicio"]
+        with self._lock:
+            self._registrar("execucao", pagina=pagina, total_s=round(total, 4),
+                            etapas={nome: round(duracao, 4) for nome, duracao in execucao["etapas"].items()})
+
+    # Chamadas ao Sheets: o hook de resposta da sessão HTTP do gspread atribui cada requisição
+    # à operação aberta na thread (a fila de escrita grava em outra thread, com a própria operação)
+    @contextmanager
+    def operacao_sheets(self, nome):
+        anterior = getattr(self._local, "operacao", None)
+        self._local.operacao = nome
+        try:
+            yield
+        finally:
+            self._local.operacao = anterior
+
+    def registrar_resposta_sheets(self, resposta, *args, **kwargs):
+        operacao = getattr(self._local, "operacao", None) or "outros"
+        enviados = len(resposta.request.body or b"")
+        recebidos = len(resposta.content or b"")
+        tempo = resposta.elapsed.total_seconds()
+        with self._lock:
+            totais = self.sheets.setdefault(operacao, {"chamadas": 0, "erros": 0, "bytes_enviados": 0, "bytes_recebidos": 0, "tempo_s": 0.0})
+            totais["chamadas"] += 1
+            totais["erros"] += not resposta.ok
+            totais["bytes_enviados"] += enviados
+            totais["bytes_recebidos"] += recebidos
+            totais["tempo_s"] += tempo
+            self._registrar("sheets", operacao=operacao, metodo=resposta.request.method, status=resposta.status_code,
+                            bytes_enviados=enviados, bytes_recebidos=recebidos, tempo_s=round(tempo, 4))
+
+    def registrar_cache(self, funcao, executou, duracao=None):
+        with self._lock:
+            totais = self.cache.setdefault(funcao, {"chamadas": 0, "execucoes": 0, "tempo_s": 0.0, "ultima_execucao_s": None})
+            totais["execucoes" if executou else "chamadas"] += 1
+            if executou:
+                totais["tempo_s"] += duracao
+                totais["ultima_execucao_s"] = duracao
+                self._registrar("cache_miss", funcao=funcao, duracao_s=round(duracao, 4))
+        execucao = getattr(self._local, "execucao", None)
+        if executou and execucao is not None:
+            execucao["calculadas"].add(funcao)
+
+    def ultima_execucao(self, funcao):
+        # (duração da última execução real da função em cache, se foi calculada neste rerun)
+        execucao = getattr(self._local, "execucao", None)
+        with self._lock:
+            duracao = self.cache.get(funcao, {}).get("ultima_execucao_s")
+        return duracao, execucao is not None and funcao in execucao["calculadas"]
+
+    def tabela_execucoes(self):
+        with self._lock:
+            execucoes = [e for e in self.eventos if e["tipo"] == "execucao"]
+        linhas = [{"Horário": e["ts"], "Página": e["pagina"], "Total (ms)": e["total_s"] * 1000,
+                   **{f"{nome} (ms)": duracao * 1000 for nome, duracao in e["etapas"].items()}} for e in execucoes]
+        return pd.DataFrame(linhas).iloc[::-1].reset_index(drop=True)
+
+    def tabela_sheets(self):
+        with self._lock:
+            totais = {operacao: dict(valores) for operacao, valores in self.sheets.items()}
+        return pd.DataFrame.from_dict(totais, orient="index").rename_axis("Operação").reset_index()
+
+    def tabela_cache(self):
+        with self._lock:
+            totais = {funcao: dict(valores) for funcao, valores in self.cache.items()}
+        tabela = pd.DataFrame.from_dict(totais, orient="index", columns=["chamadas", "execucoes", "tempo_s"]).rename_axis("Função").reset_index()
+        tabela["acertos"] = (tabela["chamadas"] - tabela["execucoes"]).clip(lower=0)
+        tabela["taxa_acerto"] = (tabela["acertos"] / tabela["chamadas"].where(tabela["chamadas"] > 0)).round(3)
+        tabela["ms_por_execucao"] = (tabela["tempo_s"] * 1000 / tabela["execucoes"].where(tabela["execucoes"] > 0)).round(1)
+        return tabela.drop(columns="tempo_s")
+
+    def exportar_jsonl(self):
+        with self._lock:
+            eventos = list(self.eventos)
+        return "\n".join(json.dumps(evento, ensure_ascii=False) for evento in eventos).encode("utf-8")
+
+@st.cache_resource
+def get_instrumentacao():
+    return Instrumentacao(os.environ.get("DIAGNOSTICO_LOG"))
+
+def cache_medido(cache=st.cache_data, **opcoes):
+    # st.cache_data/st.cache_resource que conta as chamadas e as execuções (misses) da função para a taxa de acerto
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def executar(*args, **kwargs):
+            # Só a execução real é cronometrada; o tempo fica registrado para quem recebe o resultado do cache
+            inicio = time.perf_counter()
+            resultado = funcao(*args, **kwargs)
+            get_instrumentacao().registrar_cache(funcao.__name__, executou=True, duracao=time.perf_counter() - inicio)
+            return resultado
+        em_cache = cache(**opcoes)(executar)
+
+        @functools.wraps(funcao)
+        def chamar(*args, **kwargs):
+            get_instrumentacao().registrar_cache(funcao.__name__, executou=False)
+            return em_cache(*args, **kwargs)
+        chamar.clear = em_cache.clear
+        return chamar
+    return decorador
+
+instrumentacao = get_instrumentacao()
+instrumentacao.iniciar_execucao()
+
+# --- Cliente HTTP do gspread ciente das cotas do Google Sheets ---
+# Cada requisição retira um token do balde de leitura ou de escrita (cota por minuto do usuário);
+# sem token, a chamada espera na fila em vez de receber 429. Leituras com resposta 429/5xx ou falha
+# de conexão são repetidas com backoff exponencial e jitter, e leituras idênticas simultâneas viram uma
+# só. Gravações (append, batchUpdate) só são repetidas quando recusadas por cota: após um 5xx ou uma
+# conexão perdida o servidor pode ter aplicado a gravação, e repetir duplicaria linhas. Esses erros
+# seguem para a fila de escrita e o replicador, que mantêm a alteração pendente.
+class BaldeTokens:
+    def __init__(self, por_minuto):
+        self.capacidade = por_minuto
+        self.por_segundo = por_minuto / 60
+        self.tokens = float(por_minuto)
+        self.atualizado = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.por_segundo)
+        self.atualizado = agora
+
+    def reservar(self):
+        # Reserva o próximo token (o saldo pode ficar negativo) e retorna quanto esperar por ele
+        with self._lock:
+            self._repor()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.por_segundo)
+
+    def espera_atual(self):
+        # Quanto uma nova chamada esperaria agora
+        with self._lock:
+            self._repor()
+            return max(0.0, (1 - self.tokens) / self.por_segundo)
+
+class ClienteHTTPCotas(gspread.http_client.HTTPClient):
+    COTA_LEITURA_POR_MINUTO = 60
+    COTA_ESCRITA_POR_MINUTO = 60
+    MAX_TENTATIVAS = 6
+    ESPERA_BASE = 1.0
+    ESPERA_MAXIMA = 64.0
+    STATUS_REPETIR = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.balde_leitura = BaldeTokens(self.COTA_LEITURA_POR_MINUTO)
+        self.balde_escrita = BaldeTokens(self.COTA_ESCRITA_POR_MINUTO)
+        self._lock = threading.Lock()
+        self._leituras = {}  # (endpoint, params) -> Future da leitura em andamento
+        self._esperas = deque(maxlen=500)  # (instante, segundos na fila) das últimas chamadas
+        self.em_espera = 0
+        self.repeticoes = 0
+        self.leituras_agrupadas = 0
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        argumentos = dict(params=params, data=data, json=json, files=files, headers=headers)
+        if method.upper() != "GET":
+            return self._com_cota(self.balde_escrita, method, endpoint, argumentos, idempotente=False)
+
+        chave = (endpoint, repr(params))
+        with self._lock:
+            futuro = self._leituras.get(chave)
+            lider = futuro is None
+            if lider:
+                futuro = self._leituras[chave] = Future()
+            else:
+                self.leituras_agrupadas += 1
+        if not lider:
+            return futuro.result()
+        try:
+            resposta = self._com_cota(self.balde_leitura, method, endpoint, argumentos, idempotente=True)
+            futuro.set_result(resposta)
+            return resposta
+        except Exception as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._leituras.pop(chave, None)
+
+    def _com_cota(self, balde, method, endpoint, argumentos, idempotente):
+        for tentativa in range(self.MAX_TENTATIVAS):
+            self._esperar(balde.reservar())
+            try:
+                return super().request(method, endpoint, **argumentos)
+            except gspread.exceptions.APIError as e:
+                repetir = self._recusada_por_cota(e) or (idempotente and e.code in self.STATUS_REPETIR)
+                if not repetir or tentativa == self.MAX_TENTATIVAS - 1:
+                    raise
+                retry_after = e.response.headers.get("Retry-After", "")
+                espera = float(retry_after) if retry_after.isdigit() else self._backoff(tentativa)
+            except requests.exceptions.ConnectionError:
+                if not idempotente or tentativa == self.MAX_TENTATIVAS - 1:
+                    raise
+                espera = self._backoff(tentativa)
+            with self._lock:
+                self.repeticoes += 1
+            self._esperar(espera)
+
+    def _recusada_por_cota(self, erro):
+        # Requisição recusada antes de ser aplicada: pode ser repetida mesmo sendo uma gravação
+        if erro.code == 429:
+            return True
+        # A API do Drive (client.open) sinaliza cota estourada com 403 usageLimits
+        detalhes = erro.error.get("errors") or [{}]
+        return erro.code == 403 and detalhes[0].get("domain") == "usageLimits"
+
+    def _backoff(self, tentativa):
+        # Full jitter: espera aleatória até o teto exponencial da tentativa
+        return random.uniform(0, min(self.ESPERA_MAXIMA, self.ESPERA_BASE * 2 ** tentativa))
+
+    def _esperar(self, segundos):
+        with self._lock:
+            self._esperas.append((time.monotonic(), segundos))
+            self.em_espera += segundos > 0
+        if segundos > 0:
+            try:
+                time.sleep(segundos)
+            finally:
+                with self._lock:
+                    self.em_espera -= 1
+
+    def estado(self):
+        # Atraso de fila exposto à interface: espera atual para novas chamadas e média do último minuto
+        limite = time.monotonic() - 60
+        with self._lock:
+            recentes = [segundos for instante, segundos in self._esperas if instante >= limite]
+            em_espera, repeticoes, agrupadas = self.em_espera, self.repeticoes, self.leituras_agrupadas
+        return {
+            "espera_escrita_s": self.balde_escrita.espera_atual(),
+            "espera_leitura_s": self.balde_leitura.espera_atual(),
+            "espera_media_60s": sum(recentes) / len(recentes) if recentes else 0.0,
+            "chamadas_em_espera": em_espera,
+            "repeticoes": repeticoes,
+            "leituras_agrupadas": agrupadas,
+        }
+
 # Google Sheets Setup - Use st.cache_resource for the gspread client
 @st.cache_resource
 def get_gspread_client():
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     creds_dict = json.loads(st.secrets["gspread"]["json"])
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
+    client = gspread.authorize(creds, http_client=ClienteHTTPCotas)
+    client.http_client.session.hooks["response"].append(get_instrumentacao().registrar_resposta_sheets)
     return client
 
 client = get_gspread_client()
 
-@st.cache_data(ttl=300) # Cache for 5 minutes to keep data relatively fresh
-def carregar_cpfs_ativos():
-    try:
-        sheet = client.open("consulta_ativa").sheet1
-        values = sheet.get_all_values()
-        if not values or len(values) < 2:
-            return []
-        return [row[0] for row in values[1:]]  # Ignora cabeçalho
-    except Exception as e:
-        st.error(f"Erro ao carregar CPFs ativos: {e}")
-        return []
+ABA_ATIVOS = "sheet1"
+ABA_HISTORICO = "historico"
+CABECALHOS_ABAS = {
+    "tombados": ["cpf", "contrato", "timestamp"],
+    "aguardando": ["cpf", "contrato", "timestamp"],
+    ABA_HISTORICO: ["aba", "cpf", "contrato", "timestamp", "arquivado_em"],
+}
+
+# Handles da planilha e das abas ficam em cache para não repetir client.open a cada chamada
+@st.cache_resource(show_spinner=False)
+def abrir_planilha():
+    with get_instrumentacao().operacao_sheets("abrir_planilha"):
+        return client.open("consulta_ativa")
+
+@st.cache_resource(show_spinner=False)
+def obter_aba(nome):
+    planilha = abrir_planilha()
+    with get_instrumentacao().operacao_sheets("obter_aba"):
+        if nome == ABA_ATIVOS:
+            return planilha.sheet1
+        try:
+            return planilha.worksheet(nome)
+        except gspread.exceptions.WorksheetNotFound:
+            aba = planilha.add_worksheet(title=nome, rows="1000", cols=str(len(CABECALHOS_ABAS[nome])))
+            aba.append_row(CABECALHOS_ABAS[nome])
+            return aba
+
+def ler_status_google():
+    # Lê sheet1, tombados e aguardando com um único values_batch_get
+    titulos = [obter_aba(nome).title.replace("'", "''") for nome in (ABA_ATIVOS, "tombados", "aguardando")]
+    planilha = abrir_planilha()
+    with get_instrumentacao().operacao_sheets("ler_status_google"):
+        resposta = planilha.values_batch_get([f"'{titulo}'" for titulo in titulos])
+    ativos, tomb, aguard = [faixa.get("values", []) for faixa in resposta["valueRanges"]]
+
+    cpfs_ativos = set(row[0] for row in ativos[1:] if row)  # Ignora cabeçalho
+    tombados = set((row[0], row[1]) for row in tomb[1:] if len(row) >= 2)  # (cpf, contrato)
+    aguardando = set((row[0], row[1]) for row in aguard[1:] if len(row) >= 2)
+    return cpfs_ativos, tombados, aguardando
+
+# --- Estado local dos status (SQLite) ---
+# As marcações são gravadas primeiro aqui, numa transação, e a planilha recebe as mesmas linhas
+# depois, pelo replicador. Cada alteração fica na tabela replicacao até ser confirmada no Sheets;
+# a reconciliação periódica traz as marcações feitas por outras instâncias do app.
+class EstadoLocal:
+    CONJUNTOS = ("ativos", "tombados", "aguardando")
+
+    def __init__(self, caminho):
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Uma conexão compartilhada pelas sessões; o lock serializa o acesso a ela
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conexao.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS ativos (cpf TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS tombados (cpf TEXT, contrato TEXT, PRIMARY KEY (cpf, contrato)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS aguardando (cpf TEXT, contrato TEXT, PRIMARY KEY (cpf, contrato)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS replicacao (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                conjunto TEXT NOT NULL,
+                cpf TEXT NOT NULL,
+                contrato TEXT,
+                incluir INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                replicado_em REAL
+            );
+            CREATE INDEX IF NOT EXISTS replicacao_pendentes ON replicacao (replicado_em, seq);
+            CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor) WITHOUT ROWID;
+        """)
+        linha = self._conexao.execute("SELECT valor FROM meta WHERE chave = 'reconciliado_em'").fetchone()
+        self.reconciliado_em = linha[0] if linha else None
+        self.versao = time.time_ns()  # muda a cada alteração dos conjuntos; vira versao_status
+
+    @contextmanager
+    def _transacao(self):
+        with self._lock:
+            self._conexao.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conexao
+            except BaseException:
+                self._conexao.execute("ROLLBACK")
+                raise
+            self._conexao.execute("COMMIT")
+
+    @staticmethod
+    def _sql_chave(conjunto):
+        return ("cpf = ?", "(cpf) VALUES (?)") if conjunto == "ativos" else ("cpf = ? AND contrato = ?", "(cpf, contrato) VALUES (?, ?)")
+
+    def _alterar(self, conexao, conjunto, chave, incluir):
+        # Retorna True se a linha foi de fato incluída/removida
+        condicao, valores = self._sql_chave(conjunto)
+        parametros = (chave,) if conjunto == "ativos" else chave
+        if incluir:
+            cursor = conexao.execute(f"INSERT OR IGNORE INTO {conjunto} {valores}", parametros)
+        else:
+            cursor = conexao.execute(f"DELETE FROM {conjunto} WHERE {condicao}", parametros)
+        return cursor.rowcount > 0
+
+    def marcar(self, alteracoes):
+        # alteracoes: [(conjunto, chave, incluir)]; chave é o cpf em ativos e (cpf, contrato) nos demais
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        alterou = False
+        with self._transacao() as conexao:
+            for conjunto, chave, incluir in alteracoes:
+                mudou = self._alterar(conexao, conjunto, chave, incluir)
+                alterou = alterou or mudou
+                # Inclusão repetida não gera linha nova na planilha; remoções sempre vão, a planilha
+                # pode ter a linha gravada por outra instância depois da última reconciliação
+                if mudou or not incluir:
+                    cpf, contrato = (chave, None) if conjunto == "ativos" else chave
+                    conexao.execute(
+                        "INSERT INTO replicacao (conjunto, cpf, contrato, incluir, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        (conjunto, cpf, contrato, int(incluir), timestamp),
+                    )
+            if alterou:
+                self.versao = time.time_ns()
+
+    def carregar(self):
+        # (cpfs_ativos, tombados, aguardando, versao) lidos das tabelas locais
+        with self._lock:
+            return (
+                set(cpf for cpf, in self._conexao.execute("SELECT cpf FROM ativos")),
+                set(self._conexao.execute("SELECT cpf, contrato FROM tombados")),
+                set(self._conexao.execute("SELECT cpf, contrato FROM aguardando")),
+                self.versao,
+            )
+
+    def pendentes(self, limite):
+        with self._lock:
+            return self._conexao.execute(
+                "SELECT seq, conjunto, cpf, contrato, incluir, timestamp FROM replicacao "
+                "WHERE replicado_em IS NULL ORDER BY seq LIMIT ?", (limite,)
+            ).fetchall()
+
+    def contar_pendentes(self):
+        with self._lock:
+            return self._conexao.execute("SELECT COUNT(*) FROM replicacao WHERE replicado_em IS NULL").fetchone()[0]
+
+    def podar_replicadas(self, ate):
+        # Alterações confirmadas antes de ate já estão na planilha para qualquer leitura iniciada depois;
+        # sem isso, com a leitura falhando, a tabela replicacao cresceria sem limite
+        with self._transacao() as conexao:
+            conexao.execute("DELETE FROM replicacao WHERE replicado_em < ?", (ate,))
+
+    def confirmar(self, seqs):
+        with self._transacao() as conexao:
+            conexao.executemany("UPDATE replicacao SET replicado_em = ? WHERE seq = ?", [(time.time(), seq) for seq in seqs])
+
+    def reconciliar(self, cpfs_ativos, tombados, aguardando, lido_desde):
+        # Alinha as tabelas com a leitura da planilha iniciada em lido_desde. Alterações ainda não
+        # replicadas, ou replicadas depois do início da leitura, não estão nela e são reaplicadas.
+        # Só as diferenças são gravadas, e a versão só muda se algo mudou.
+        with self._transacao() as conexao:
+            alvo = {"ativos": set(cpfs_ativos), "tombados": set(tombados), "aguardando": set(aguardando)}
+            for conjunto, cpf, contrato, incluir in conexao.execute(
+                "SELECT conjunto, cpf, contrato, incluir FROM replicacao "
+                "WHERE replicado_em IS NULL OR replicado_em >= ? ORDER BY seq", (lido_desde,)
+            ):
+                chave = cpf if conjunto == "ativos" else (cpf, contrato)
+                (alvo[conjunto].add if incluir else alvo[conjunto].discard)(chave)
+            # O tombado é gravado antes de a linha sair do aguardando (nesta ou em outra instância);
+            # uma leitura entre os dois passos traria o contrato nas duas abas
+            alvo["aguardando"] -= alvo["tombados"]
+
+            alterou = False
+            for conjunto in self.CONJUNTOS:
+                if conjunto == "ativos":
+                    atual = set(cpf for cpf, in conexao.execute("SELECT cpf FROM ativos"))
+                    linhas = lambda chaves: [(cpf,) for cpf in chaves]
+                else:
+                    atual = set(conexao.execute(f"SELECT cpf, contrato FROM {conjunto}"))
+                    linhas = list
+                condicao, valores = self._sql_chave(conjunto)
+                removidas, incluidas = atual - alvo[conjunto], alvo[conjunto] - atual
+                conexao.executemany(f"DELETE FROM {conjunto} WHERE {condicao}", linhas(removidas))
+                conexao.executemany(f"INSERT INTO {conjunto} {valores}", linhas(incluidas))
+                alterou = alterou or bool(removidas or incluidas)
+
+            conexao.execute("DELETE FROM replicacao WHERE replicado_em < ?", (lido_desde,))
+            self.reconciliado_em = time.time()
+            conexao.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('reconciliado_em', ?)", (self.reconciliado_em,))
+            if alterou:
+                self.versao = time.time_ns()
+        return alterou
 
-@st.cache_data(ttl=300)
-def carregar_tombados_google():
-    try:
-        tomb_sheet = client.open("consulta_ativa").worksheet("tombados")
-        values = tomb_sheet.get_all_values()
-        if not values or len(values) < 2:
-            return set()
-        return set((row[0], row[1]) for row in values[1:])  # (cpf, contrato)
-    except Exception as e:
-        st.error(f"Erro ao carregar registros tombados: {e}")
-        return set()
-
-@st.cache_data(ttl=300)
-def carregar_aguardando_google():
-    try:
-        aguard_sheet = client.open("consulta_ativa").worksheet("aguardando")
-        values = aguard_sheet.get_all_values()
-        if not values or len(values) < 2:
-            return set()
-        return set((row[0], row[1]) for row in values[1:])
-    except Exception as e:
-        st.error(f"Erro ao carregar registros aguardando: {e}")
-        return set()
-
-# Functions that modify Google Sheets should not be cached, but their calls should invalidate relevant caches
-def marcar_tombado(cpf, contrato):
-    # Adiciona ao tombados
-    try:
-        tomb_sheet = client.open("consulta_ativa").worksheet("tombados")
-    except:
-        tomb_sheet = client.open("consulta_ativa").add_worksheet(title="tombados", rows="1000", cols="3")
-        tomb_sheet.append_row(["cpf", "contrato", "timestamp"])
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    tomb_sheet.append_row([cpf, contrato, timestamp])
-
-    # Remove da aba aguardando, se existir
-    try:
-        aguard_sheet = client.open("consulta_ativa").worksheet("aguardando")
-        data = aguard_sheet.get_all_values()
-        header = data[0]
-        rows = data[1:]
-        nova_lista = [row for row in rows if not (row[0] == cpf and row[1] == contrato)]
-
-        aguard_sheet.clear()
-        aguard_sheet.append_row(header)
-        for row in nova_lista:
-            aguard_sheet.append_row(row)
-    except Exception as e:
-        st.warning(f"Erro ao remover da aba aguardando: {e}")
-
-    st.cache_data.clear()  # Invalida caches relacionados # Invalidate cache for tombados data
+@st.cache_resource
+def get_estado_local():
+    return EstadoLocal(ESTADO_PATH)
+
+# --- Status com stale-while-revalidate sobre o estado local ---
+# Todas as sessões leem o último snapshot (cpfs_ativos, tombados, aguardando, versao_status), recarregado
+# do SQLite quando o estado muda. Quando a última reconciliação passa de TTL segundos, uma thread em
+# segundo plano lê a planilha e reconcilia o estado local. Só a primeira execução com o banco vazio
+# espera pela leitura; nas seguintes (inclusive após reiniciar o app) o estado local já serve.
+class StatusSheets:
+    TTL = 300
+    ESPERA_APOS_ERRO = 30
+
+    def __init__(self, estado):
+        self.estado = estado
+        self._lock = threading.Lock()
+        self._lock_leitura = threading.Lock()
+        self._snapshot = None
+        self.lido_em = estado.reconciliado_em
+        self.proxima_leitura = 0.0
+        self.atualizando = False
+        self.erro = None
+
+    def obter(self):
+        if self.lido_em is None and time.time() >= self.proxima_leitura:
+            # Estado local nunca foi reconciliado: ainda não há o que servir. Depois de uma primeira
+            # leitura com erro, espera ESPERA_APOS_ERRO como o caminho normal e serve o estado vazio com o erro
+            self.atualizar(primeira=True)
+        with self._lock:
+            if time.time() >= self.proxima_leitura:
+                self._revalidar()
+            if self._snapshot is None or self._snapshot[3] != self.estado.versao:
+                self._snapshot = self.estado.carregar()
+            return self._snapshot
+
+    def revalidar(self):
+        with self._lock:
+            self._revalidar()
+
+    def _revalidar(self):
+        if not self.atualizando:
+            self.atualizando = True
+            threading.Thread(target=self.atualizar, daemon=True, name="status-sheets").start()
+
+    def atualizar(self, primeira=False):
+        with self._lock_leitura:
+            if primeira and (self.lido_em is not None or time.time() < self.proxima_leitura):
+                return  # outra sessão fez a primeira carga (ou falhou nela) enquanto esta esperava
+            lido_desde = time.time()
+            try:
+                cpfs_ativos, tombados, aguardando = ler_status_google()
+                self.estado.reconciliar(cpfs_ativos, tombados, aguardando, lido_desde)
+            except Exception as e:
+                # As leituras são serializadas por _lock_leitura: nenhuma outra começou antes desta
+                self.estado.podar_replicadas(lido_desde)
+                with self._lock:
+                    self.erro = e
+                    self.proxima_leitura = time.time() + self.ESPERA_APOS_ERRO
+                    self.atualizando = False
+                return
+            with self._lock:
+                self.lido_em = self.estado.reconciliado_em
+                self.proxima_leitura = self.lido_em + self.TTL
+                self.atualizando = False
+                self.erro = None
+
+    def idade(self):
+        return None if self.lido_em is None else time.time() - self.lido_em
+
+@st.cache_resource
+def get_status_sheets():
+    return StatusSheets(get_estado_local())
+
+# Fila de escrita (write-behind): agrupa as marcações pendentes e grava tudo
+# com um único append_rows por aba, ao atingir max_linhas ou max_espera segundos.
+class FilaEscritaSheets:
+    def __init__(self, max_linhas=500, max_espera=2.0):
+        self.max_linhas = max_linhas
+        self.max_espera = max_espera
+        self._pendentes = {}  # aba -> [(linha, Future)]
+        self._lock = threading.Lock()
+        self._lock_gravacao = threading.Lock()
+        self._timer = None
+
+    def enfileirar(self, aba, linha):
+        futuro = Future()
+        with self._lock:
+            self._pendentes.setdefault(aba, []).append((linha, futuro))
+            total = sum(len(itens) for itens in self._pendentes.values())
+            if self._timer is None:
+                self._timer = threading.Timer(self.max_espera, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if total >= self.max_linhas:
+            self.flush()
+        return futuro
+
+    def flush(self):
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        with self._lock_gravacao:
+            for aba, itens in pendentes.items():
+                try:
+                    destino = obter_aba(aba)
+                    with get_instrumentacao().operacao_sheets(f"fila_escrita:{aba}"):
+                        destino.append_rows([linha for linha, _ in itens], value_input_option="RAW")
+                except Exception as e:
+                    for _, futuro in itens:
+                        futuro.set_exception(e)
+                else:
+                    for _, futuro in itens:
+                        futuro.set_result(True)
+
+@st.cache_resource
+def get_fila_escrita():
+    return FilaEscritaSheets()
+
+def remover_aguardando(chaves):
+    # Localiza as linhas das chaves (cpf, contrato) na aba aguardando e apaga todas
+    # com um único batch_update, em vez de limpar e regravar a aba inteira.
+    chaves = set(chaves)
+    if not chaves:
+        return 0
+    aguard_sheet = obter_aba("aguardando")
+    with get_instrumentacao().operacao_sheets("remover_aguardando"):
+        valores = aguard_sheet.get_values("A:B")
+    indices = [i for i, row in enumerate(valores) if i > 0 and len(row) >= 2 and (row[0], row[1]) in chaves]
+    apagar_linhas(aguard_sheet, indices, "remover_aguardando")
+    return len(indices)
+
+def apagar_linhas(aba, indices, operacao):
+    # Apaga as linhas (índices a partir de 0) com um único batch_update. Índices consecutivos viram
+    # uma faixa, e as faixas são apagadas de baixo para cima para não deslocar as demais.
+    faixas = []
+    for i in sorted(indices):
+        if faixas and faixas[-1][1] == i:
+            faixas[-1][1] = i + 1
+        else:
+            faixas.append([i, i + 1])
+    if not faixas:
+        return
+    requests = [
+        {"deleteDimension": {"range": {"sheetId": aba.id, "dimension": "ROWS", "startIndex": inicio, "endIndex": fim}}}
+        for inicio, fim in reversed(faixas)
+    ]
+    with get_instrumentacao().operacao_sheets(operacao):
+        aba.spreadsheet.batch_update({"requests": requests})
+
+# Replicação assíncrona: uma thread leva as alterações pendentes do estado local para a planilha,
+# em rodadas de até POR_RODADA alterações (append_rows pela fila de escrita e uma remoção agrupada do
+# aguardando). O que falhar continua pendente e é tentado de novo após ESPERA_APOS_ERRO segundos.
+class ReplicadorSheets:
+    INTERVALO = 5
+    POR_RODADA = 5000
+    ESPERA_APOS_ERRO = 30
+    ABAS = {"ativos": ABA_ATIVOS, "tombados": "tombados", "aguardando": "aguardando"}
+
+    def __init__(self, estado):
+        self.estado = estado
+        self._lock = threading.Lock()
+        self._aviso = threading.Event()
+        self.erro = None
+        self.replicado_em = None
+        threading.Thread(target=self._executar, daemon=True, name="replicador-sheets").start()
+
+    def avisar(self):
+        self._aviso.set()
+
+    @contextmanager
+    def pausado(self):
+        # Nenhuma rodada de replicação começa enquanto o bloco executa
+        with self._lock:
+            yield
+
+    def _executar(self):
+        while True:
+            self._aviso.wait(self.INTERVALO)
+            self._aviso.clear()
+            try:
+                self.replicar()
+            except Exception as e:
+                self.erro = e
+                time.sleep(self.ESPERA_APOS_ERRO)
+
+    def replicar(self):
+        # Retorna o número de alterações confirmadas na planilha
+        fila = get_fila_escrita()
+        total = 0
+        with self._lock:
+            while True:
+                pendentes = self.estado.pendentes(self.POR_RODADA)
+                if not pendentes:
+                    self.erro = None
+                    return total
+                futuros, remocoes = [], []
+                for seq, conjunto, cpf, contrato, incluir, timestamp in pendentes:
+                    if not incluir:
+                        remocoes.append((seq, (cpf, contrato)))
+                    else:
+                        linha = [cpf, timestamp] if conjunto == "ativos" else [cpf, contrato, timestamp]
+                        futuros.append((seq, fila.enfileirar(self.ABAS[conjunto], linha)))
+                fila.flush()
+
+                # As linhas gravadas são confirmadas já, antes da remoção: se ela falhar, a próxima
+                # rodada tenta só a remoção de novo, sem gravar as mesmas linhas outra vez
+                confirmados = [seq for seq, futuro in futuros if futuro.exception() is None]
+                self.estado.confirmar(confirmados)
+                total += len(confirmados)
+                erro = next((futuro.exception() for _, futuro in futuros if futuro.exception() is not None), None)
+                if remocoes and erro is None:
+                    # Só remove do aguardando depois que as inclusões da rodada (o tombado) foram gravadas
+                    try:
+                        remover_aguardando(chave for _, chave in remocoes)
+                    except Exception as e:
+                        erro = e
+                    else:
+                        self.estado.confirmar([seq for seq, _ in remocoes])
+                        total += len(remocoes)
+                self.replicado_em = time.time()
+                if erro is not None:
+                    raise erro
+
+@st.cache_resource
+def get_replicador():
+    return ReplicadorSheets(get_estado_local())
+
+# --- Compactação das abas de status ---
+# As abas só crescem: a mesma chave pode ter sido marcada várias vezes (por outras instâncias ou antes
+# do estado local). A compactação deixa em cada aba só a linha mais recente de cada chave e move as
+# demais, e as linhas sem chave, para a aba historico, que o app nunca lê. As linhas são apagadas no
+# lugar (sem regravar a aba), então o que for gravado durante a compactação não se perde.
+def compactar_abas_status():
+    arquivado_em = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    relatorio = []
+    with get_replicador().pausado():
+        historico = None
+        for nome in (ABA_ATIVOS, "tombados", "aguardando"):
+            titulo, valores, descartadas, situacao = nome, [], [], "ok"
+            try:
+                if historico is None:
+                    historico = obter_aba(ABA_HISTORICO)
+                aba = obter_aba(nome)
+                titulo = aba.title
+                with get_instrumentacao().operacao_sheets("compactar_abas_status"):
+                    valores = aba.get_all_values()
+                largura = 1 if nome == ABA_ATIVOS else 2  # colunas da chave; a seguinte é o timestamp
+
+                mais_recente = {}  # chave -> índice da linha mantida
+                for i, row in enumerate(valores[1:], start=1):
+                    chave = tuple(row[:largura])
+                    if len(chave) < largura or not all(chave):
+                        descartadas.append(i)
+                        continue
+                    anterior = mais_recente.get(chave)
+                    if anterior is None:
+                        mais_recente[chave] = i
+                    elif row[largura:largura + 1] >= valores[anterior][largura:largura + 1]:
+                        descartadas.append(anterior)  # timestamps "%Y-%m-%d %H:%M:%S" ordenam como texto
+                        mais_recente[chave] = i
+                    else:
+                        descartadas.append(i)
+
+                if descartadas:
+                    # Arquiva antes de apagar: uma linha repetida no historico não faz mal, uma perdida sim
+                    arquivo = []
+                    for i in sorted(descartadas):
+                        row = valores[i] + [""] * (largura + 1 - len(valores[i]))
+                        contrato = row[1] if largura == 2 else ""
+                        arquivo.append([titulo, row[0], contrato, row[largura], arquivado_em])
+                    with get_instrumentacao().operacao_sheets("compactar_abas_status"):
+                        historico.append_rows(arquivo, value_input_option="RAW")
+                    # Outra sessão pode ter apagado linhas desde a leitura; os índices só valem
+                    # se as linhas lidas continuam iguais (appends só acrescentam ao final).
+                    with get_instrumentacao().operacao_sheets("compactar_abas_status"):
+                        alterada = aba.get_all_values()[:len(valores)] != valores
+                    if alterada:
+                        descartadas = []
+                        situacao = "alterada durante a leitura; compacte de novo"
+                    else:
+                        apagar_linhas(aba, descartadas, "compactar_abas_status")
+            except Exception as e:
+                descartadas = []
+                situacao = f"erro: {e}"
+
+            tamanho = [sum(len(celula.encode()) for celula in row) for row in valores[1:]]
+            tamanho_descartado = sum(tamanho[i - 1] for i in descartadas)
+            relatorio.append({
+                "Aba": titulo,
+                "Linhas antes": len(tamanho),
+                "Linhas depois": len(tamanho) - len(descartadas),
+                "Arquivadas": len(descartadas),
+                "KB antes": round(sum(tamanho) / 1024, 1),
+                "KB depois": round((sum(tamanho) - tamanho_descartado) / 1024, 1),
+                "Situação": situacao,
+            })
+    return relatorio
+
+# Functions that modify Google Sheets should not be cached; as marcações vão para o estado local
+# numa única transação e o replicador é avisado para gravá-las na planilha em segundo plano.
+def marcar(alteracoes):
+    get_estado_local().marcar(alteracoes)
+    get_replicador().avisar()
+
+def alteracoes_tombado(cpf, contrato):
+    # Adiciona ao tombados e remove do aguardando, se existir
+    return [("tombados", (cpf, contrato), True), ("aguardando", (cpf, contrato), False)]
 
 def marcar_cpf_ativo(cpf):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sheet = client.open("consulta_ativa").sheet1 # Get the sheet reference again
-    sheet.append_row([cpf, timestamp])
-    st.cache_data.clear() # Invalidate cache for active CPFs
-
-def marcar_aguardando(cpf, contrato):
-    try:
-        aguard_sheet = client.open("consulta_ativa").worksheet("aguardando")
-    except:
-        aguard_sheet = client.open("consulta_ativa").add_worksheet(title="aguardando", rows="1000", cols="3")
-        aguard_sheet.append_row(["cpf", "contrato", "timestamp"])
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    aguard_sheet.append_row([cpf, contrato, timestamp])
-    st.cache_data.clear() # Invalidate cache for aguardando data
+    marcar([("ativos", cpf, True)])
 
 # Initialize session state variables
-for key in ["autenticado", "arquivo_novo", "arquivo_tomb", "novo_df", "tomb_df", "ultimo_cpf_consultado"]:
+for key in ["autenticado", "arquivo_novo", "arquivo_tomb", "ultimo_cpf_consultado", "relatorio_compactacao", "mudancas_bases"]:
     if key not in st.session_state:
-        st.session_state[key] = None if key not in ["autenticado", "novo_df", "tomb_df"] else False if key == "autenticado" else pd.DataFrame()
+        st.session_state[key] = False if key == "autenticado" else None
 
 DATA_DIR = "data"
 NOVO_PATH = os.path.join(DATA_DIR, "novoemprestimo.xlsx")
 TOMB_PATH = os.path.join(DATA_DIR, "tombamento.xlsx")
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
+ESTADO_PATH = os.path.join(DATA_DIR, "estado.sqlite3")
+SNAPSHOT_VERSAO = 2  # Incrementar ao mudar o tratamento das bases, para descartar snapshots antigos
 
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
+if not os.path.exists(SNAPSHOT_DIR):
+    os.makedirs(SNAPSHOT_DIR)
 
 def autenticar():
     senha = st.text_input("Digite a senha para acessar o sistema:", type="password")
@@ -128,35 +863,199 @@ if not st.session_state.autenticado:
     autenticar()
     st.stop()
 
-@st.cache_data
-def formatar_documentos(df_input, col, tamanho):
-    df = df_input.copy() # Work on a copy to avoid SettingWithCopyWarning
+def formatar_documentos(df, col, tamanho):
+    # Só roda na geração do snapshot, sobre o DataFrame recém-lido do XLSX
     df[col] = df[col].astype(str).str.replace(r'\D', '', regex=True).str.zfill(tamanho)
     return df
 
-@st.cache_data
-def load_and_process_data(novo_path, tomb_path):
-    novo_df = pd.read_excel(novo_path)
-    tomb_df = pd.read_excel(tomb_path)
+# Snapshots colunares (Feather/Arrow) das bases, nomeados pelo hash do XLSX de origem:
+# o XLSX é lido pelo openpyxl uma única vez e as cargas seguintes fazem memory-map do snapshot.
+def caminho_snapshot(path):
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    base = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(SNAPSHOT_DIR, f"{base}.v{SNAPSHOT_VERSAO}.{digest}.feather")
+
+# Colunas comparadas com números (get_filtered_df): um texto como "N/D" não pode transformá-las em
+# texto na normalização abaixo, senão 140073 vira "140073" e deixa de ser filtrado
+COLUNAS_NUMERICAS = ['Código Linha Crédito']
+
+def normalizar_para_arrow(df):
+    # Arrow exige nomes de coluna em texto e um tipo por coluna; colunas mistas viram texto
+    df.columns = [str(c) for c in df.columns]
+    for col in COLUNAS_NUMERICAS:
+        if col in df.columns:
+            numeros = pd.to_numeric(df[col], errors="coerce")
+            inteiros = numeros.dropna()
+            df[col] = numeros.astype("Int64") if (inteiros == inteiros.round()).all() else numeros
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed"):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
 
-    novo_df = formatar_documentos(novo_df, 'Número CPF/CNPJ', 11)
-    tomb_df = formatar_documentos(tomb_df, 'CPF Tomador', 11)
-    if 'Número Contrato' in tomb_df.columns:
-        tomb_df['Número Contrato'] = tomb_df['Número Contrato'].astype(str)
-    if 'Número Contrato Crédito' in novo_df.columns:
-        novo_df['Número Contrato Crédito'] = novo_df['Número Contrato Crédito'].astype(str)
+def gerar_snapshot(path, col_cpf, col_contrato):
+    df = pd.read_excel(path)
+    df = formatar_documentos(df, col_cpf, 11)
+    if col_contrato in df.columns:
+        df[col_contrato] = df[col_contrato].astype(str)
+    df = normalizar_para_arrow(df)
+
+    snapshot = caminho_snapshot(path)
+    temporario = snapshot + ".tmp"
+    feather.write_feather(df, temporario, compression="uncompressed")  # sem compressão para permitir memory-map
+    os.replace(temporario, snapshot)
+
+    # Remove snapshots anteriores da mesma base
+    prefixo = os.path.splitext(os.path.basename(path))[0] + "."
+    for nome in os.listdir(SNAPSHOT_DIR):
+        if nome.startswith(prefixo) and os.path.join(SNAPSHOT_DIR, nome) != snapshot:
+            os.remove(os.path.join(SNAPSHOT_DIR, nome))
+    return df
 
+def carregar_base(path, col_cpf, col_contrato):
+    snapshot = caminho_snapshot(path)
+    if os.path.exists(snapshot):
+        return feather.read_table(snapshot, memory_map=True).to_pandas()
+    return gerar_snapshot(path, col_cpf, col_contrato)
+
+# --- Layout compacto das bases ---
+# CPF e contrato viram inteiros (quando o texto volta idêntico do inteiro, nas duas bases, para os
+# joins continuarem batendo) e colunas de texto repetitivo viram categorias. O texto das chaves só
+# é refeito nas bordas: IndiceBase converte as chaves vindas da planilha/lotes e para_exibicao
+# devolve os 11 dígitos do CPF nas tabelas exibidas e exportadas.
+COLUNAS_CHAVE = {
+    "cpf": [("novo", 'Número CPF/CNPJ'), ("tomb", 'CPF Tomador')],
+    "contrato": [("novo", 'Número Contrato Crédito'), ("tomb", 'Número Contrato')],
+}
+FORMATO_CHAVE = {"cpf": r"\d{11}", "contrato": r"[1-9]\d{0,17}"}  # sem zeros à esquerda, cabe em int64
+COLUNAS_CATEGORIAS = ['Código Linha Crédito']
+LIMITE_CATEGORIA = 0.5  # colunas de texto com até 50% de valores distintos viram categoria
+COLUNAS_CPF = ['Número CPF/CNPJ', 'CPF Tomador', 'CPF']
+
+def compactar_bases(novo_df, tomb_df):
+    bases = {"novo": novo_df, "tomb": tomb_df}
+    for tipo, colunas in COLUNAS_CHAVE.items():
+        colunas = [(nome, col) for nome, col in colunas if col in bases[nome].columns]
+        if all(bases[nome][col].astype(str).str.fullmatch(FORMATO_CHAVE[tipo]).all() for nome, col in colunas):
+            for nome, col in colunas:
+                bases[nome][col] = bases[nome][col].astype(str).astype(np.int64)
+    chaves = {col for colunas in COLUNAS_CHAVE.values() for _, col in colunas}
+    for df in bases.values():
+        for col in df.columns:
+            if col in chaves or not len(df):
+                continue
+            texto = pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])
+            if col in COLUNAS_CATEGORIAS or (texto and df[col].nunique() <= LIMITE_CATEGORIA * len(df)):
+                df[col] = df[col].astype("category")
     return novo_df, tomb_df
 
+def chaves_inteiras(valores, largura=None):
+    # Chaves em texto -> inteiros da base compacta; o que não é a forma exata do inteiro vira -1 (não encontrado)
+    texto = pd.Series(valores, dtype=object).astype(str)
+    numeros = pd.to_numeric(texto.where(texto.str.fullmatch(r"\d{1,18}"), "-1")).to_numpy(dtype=np.int64, copy=True)
+    canonico = pd.Series(numeros).astype(str)
+    if largura:
+        canonico = canonico.str.zfill(largura)
+    numeros[canonico.to_numpy() != texto.to_numpy()] = -1
+    return numeros
+
+def chave_inteira(valor, largura=None):
+    # Versão escalar de chaves_inteiras, para as consultas de um CPF por vez
+    texto = str(valor)
+    if not (texto.isascii() and texto.isdigit()) or len(texto) > 18:
+        return -1
+    numero = int(texto)
+    return numero if (str(numero).zfill(largura) if largura else str(numero)) == texto else -1
+
+def para_exibicao(df_input):
+    # CPFs guardados como inteiros voltam aos 11 dígitos para exibir e exportar
+    colunas = {
+        col: df_input[col].astype(str).str.zfill(11)
+        for col in COLUNAS_CPF if col in df_input.columns and pd.api.types.is_integer_dtype(df_input[col])
+    }
+    return df_input.assign(**colunas) if colunas else df_input
+
+def preencher_consignante(serie):
+    # Contratos sem tombamento aparecem como "CONSULTE SISBR"; colunas categóricas precisam ganhar a categoria
+    if isinstance(serie.dtype, pd.CategoricalDtype) and "CONSULTE SISBR" not in serie.cat.categories:
+        serie = serie.cat.add_categories(["CONSULTE SISBR"])
+    return serie.fillna("CONSULTE SISBR")
+
+def load_and_process_data(novo_path, tomb_path):
+    novo_df = carregar_base(novo_path, 'Número CPF/CNPJ', 'Número Contrato Crédito')
+    tomb_df = carregar_base(tomb_path, 'CPF Tomador', 'Número Contrato')
+    return compactar_bases(novo_df, tomb_df)
+
+def invalidar_bases():
+    get_bases.clear()
+    calculate_counts.clear()
+    get_indice_base.clear()
+    get_resumo_consignante.clear()
+
+def diferenca_bases(anterior, atual, col_cpf, col_contrato):
+    # Resumo das mudanças exibido ao operador em "Atualizar Bases": chaves (CPF, contrato) inseridas,
+    # removidas e alteradas (presentes nas duas com algum outro campo diferente). Só informa; as
+    # tabelas derivadas são remontadas pela nova versão da base (o ResumoConsignante herda os status).
+    chave = [col_cpf, col_contrato]
+    colunas = [col for col in atual.columns.intersection(anterior.columns, sort=False) if col not in chave]
+    anterior = anterior.drop_duplicates(chave, keep="last").reset_index(drop=True)
+    atual = atual.drop_duplicates(chave, keep="last").reset_index(drop=True)
+    # Chaves codificadas em inteiros como no IndiceBase, em vez de um join sobre as colunas de texto
+    codigos_cpf, _ = pd.factorize(pd.concat([anterior[col_cpf], atual[col_cpf]], ignore_index=True), use_na_sentinel=False)
+    codigos_contrato, contratos = pd.factorize(pd.concat([anterior[col_contrato], atual[col_contrato]], ignore_index=True), use_na_sentinel=False)
+    codigos = codigos_cpf.astype(np.int64) * len(contratos) + codigos_contrato
+    codigos_antes, codigos_atual = pd.Index(codigos[:len(anterior)]), pd.Index(codigos[len(anterior):])
+    posicoes = codigos_antes.get_indexer(codigos_atual)  # linha de cada chave atual na versão anterior; -1 se inserida
+    existe = posicoes >= 0
+    removidas = codigos_atual.get_indexer(codigos_antes) < 0
+
+    iguais = np.ones(existe.sum(), dtype=bool)
+    for col in colunas:
+        a = anterior[col].take(posicoes[existe]).reset_index(drop=True)
+        b = atual.loc[existe, col].reset_index(drop=True)
+        if a.dtype != b.dtype:
+            a, b = a.astype(str), b.astype(str)
+        iguais &= (a.eq(b) | (a.isna() & b.isna())).to_numpy()
+    return {
+        "linhas_antes": len(anterior),
+        "linhas_depois": len(atual),
+        "inseridos": atual.loc[~existe, chave].reset_index(drop=True),
+        "removidos": anterior.loc[removidas, chave].reset_index(drop=True),
+        "alterados": atual.loc[existe, chave][~iguais].reset_index(drop=True),
+        "colunas_novas": list(atual.columns.difference(anterior.columns)),
+        "colunas_removidas": list(anterior.columns.difference(atual.columns)),
+    }
+
 def salvar_arquivos(upload_novo, upload_tomb):
-    with open(NOVO_PATH, "wb") as f:
-        f.write(upload_novo.read())
-    with open(TOMB_PATH, "wb") as f:
-        f.write(upload_tomb.read())
-    # Invalidate caches that depend on these files
-    st.cache_data.clear() # Clears all @st.cache_data caches
-    # Re-load processed data into session state
-    st.session_state.novo_df, st.session_state.tomb_df = load_and_process_data(NOVO_PATH, TOMB_PATH)
+    # Retorna, por base, a diferença para a versão anterior (None na primeira carga; "igual" se o
+    # arquivo enviado é idêntico ao atual, que então nem é regravado)
+    mudancas = {}
+    for nome, upload, path, col_cpf, col_contrato in [
+        ("NovoEmprestimo", upload_novo, NOVO_PATH, 'Número CPF/CNPJ', 'Número Contrato Crédito'),
+        ("Tombamento", upload_tomb, TOMB_PATH, 'CPF Tomador', 'Número Contrato'),
+    ]:
+        conteudo = upload.read()
+        anterior = None
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.read() == conteudo:
+                    mudancas[nome] = "igual"
+                    continue
+            anterior = carregar_base(path, col_cpf, col_contrato)
+        with open(path, "wb") as f:
+            f.write(conteudo)
+        # Converte cada upload uma única vez no snapshot colunar lido pelas próximas cargas
+        atual = gerar_snapshot(path, col_cpf, col_contrato)
+        mudancas[nome] = None if anterior is None else diferenca_bases(anterior, atual, col_cpf, col_contrato)
+    # Invalidate caches that depend on these files (the Sheets data stays cached)
+    if any(mudanca != "igual" for mudanca in mudancas.values()):
+        invalidar_bases()
+    return mudancas
+
+
+# Versão das bases: cresce a cada upload (as duas são gravadas juntas por salvar_arquivos)
+def versao_das_bases():
+    return max(os.stat(NOVO_PATH).st_mtime_ns, os.stat(TOMB_PATH).st_mtime_ns)
 
 
 # --- Data Loading and Pre-processing (Centralized and Cached) ---
@@ -170,90 +1069,371 @@ if not os.path.exists(NOVO_PATH) or not os.path.exists(TOMB_PATH):
         st.rerun()
     else:
         st.stop()
-else:
-    # Load data once and store in session state
-    if st.session_state.novo_df.empty or st.session_state.tomb_df.empty:
-        st.session_state.novo_df, st.session_state.tomb_df = load_and_process_data(NOVO_PATH, TOMB_PATH)
-
-# Retrieve data for calculations and display
-df = st.session_state.novo_df
-tomb = st.session_state.tomb_df
-cpfs_ativos = carregar_cpfs_ativos()
-tombados = carregar_tombados_google()
-aguardando = carregar_aguardando_google()
+
+with instrumentacao.etapa("status_sheets"):
+    status_sheets = get_status_sheets()
+    cpfs_ativos, tombados, aguardando, versao_status = status_sheets.obter()
+if status_sheets.erro is not None and status_sheets.lido_em is None:
+    st.error(f"Erro ao carregar dados da planilha consulta_ativa: {status_sheets.erro}")
 
 # Filter initial DataFrame once for common conditions
-@st.cache_data
 def get_filtered_df(df_input):
     return df_input[
         (df_input['Submodalidade Bacen'] == 'CRÉDITO PESSOAL - COM CONSIGNAÇÃO EM FOLHA DE PAGAM.') &
         (df_input['Critério Débito'] == 'FOLHA DE PAGAMENTO') &
         (~df_input['Código Linha Crédito'].isin([140073, 138358, 141011, 101014, 137510]))
-    ].copy()
-
-filtered_common_df = get_filtered_df(df)
+    ]
+
+# Uma única cópia das bases (compacta e somente leitura) por processo, compartilhada por todas as
+# sessões; cada rerun só pega referências a ela em vez de guardar cópias em st.session_state
+@st.cache_resource(show_spinner="Carregando bases...")
+def get_bases(versao_base):
+    novo_df, tomb_df = load_and_process_data(NOVO_PATH, TOMB_PATH)
+    return novo_df, tomb_df, get_filtered_df(novo_df)
+
+versao_base = versao_das_bases()
+with instrumentacao.etapa("bases"):
+    df, tomb, filtered_common_df = get_bases(versao_base)
+
+# Índice hash da base: CPF -> posições das linhas e chave (CPF, contrato) codificada em inteiro,
+# para as checagens de existência e os joins não varrerem nem re-hashearem as colunas de texto.
+# Com a base compacta, as chaves em texto recebidas (planilha, lotes, digitação) são convertidas
+# para inteiros aqui, na entrada do índice.
+class IndiceBase:
+    def __init__(self, df_input, col_cpf='Número CPF/CNPJ', col_contrato='Número Contrato Crédito'):
+        self.df = df_input
+        self._cpf_inteiro = pd.api.types.is_integer_dtype(df_input[col_cpf])
+        self._contrato_inteiro = pd.api.types.is_integer_dtype(df_input[col_contrato])
+        self.posicoes_cpf = df_input.groupby(col_cpf, sort=False).indices if len(df_input) else {}
+        # codigo = codigo_cpf * n_contratos + codigo_contrato
+        codigos_cpf, cpfs = pd.factorize(df_input[col_cpf])
+        codigos_contrato, contratos = pd.factorize(df_input[col_contrato])
+        self._cpfs = pd.Index(cpfs, dtype=object)  # dtype fixo: a hashtable do Index é montada uma única vez
+        self._contratos = pd.Index(contratos, dtype=object)
+        self.codigos = pd.Index(codigos_cpf.astype(np.int64) * len(self._contratos) + codigos_contrato)
+        self._mascara_tombamento = None
+
+    def _chaves_cpf(self, cpfs):
+        if self._cpf_inteiro and not pd.api.types.is_integer_dtype(np.asarray(cpfs)):
+            return chaves_inteiras(cpfs, largura=11)
+        return cpfs
+
+    def _chaves_contrato(self, contratos):
+        if self._contrato_inteiro and not pd.api.types.is_integer_dtype(np.asarray(contratos)):
+            return chaves_inteiras(contratos)
+        return contratos
+
+    def codificar(self, cpfs, contratos):
+        # Códigos das chaves informadas; -1 quando o CPF ou o contrato não existe na base
+        codigos_cpf = self._cpfs.get_indexer(pd.Index(self._chaves_cpf(cpfs), dtype=object)).astype(np.int64)
+        codigos_contrato = self._contratos.get_indexer(pd.Index(self._chaves_contrato(contratos), dtype=object))
+        codigos = codigos_cpf * len(self._contratos) + codigos_contrato
+        codigos[(codigos_cpf < 0) | (codigos_contrato < 0)] = -1
+        return codigos
+
+    def mascara(self, cpfs, contratos):
+        # Semi-join: linhas da base cuja chave está entre as informadas
+        codigos = self.codificar(cpfs, contratos)
+        return self.codigos.isin(codigos[codigos >= 0])
+
+    def presentes(self, cpfs, contratos):
+        # Para cada chave informada, se ela existe na base
+        return pd.Index(self.codificar(cpfs, contratos)).isin(self.codigos)
+
+    def mascara_tombamento(self, tomb_df):
+        # O tombamento só muda junto com a base (salvar_arquivos limpa os índices), então o semi-join fica guardado
+        if self._mascara_tombamento is None:
+            self._mascara_tombamento = self.mascara(tomb_df['CPF Tomador'], tomb_df['Número Contrato'])
+        return self._mascara_tombamento
+
+    def posicoes(self, cpfs):
+        # Posições das linhas dos CPFs informados
+        chaves = self._chaves_cpf(list(cpfs))
+        posicoes = [self.posicoes_cpf[cpf] for cpf in chaves if cpf in self.posicoes_cpf]
+        return np.concatenate(posicoes) if posicoes else np.array([], dtype=np.int64)
+
+    def mascara_cpfs(self, cpfs):
+        # Linhas da base cujo CPF está entre os informados, via posições do índice
+        mascara = np.zeros(len(self.df), dtype=bool)
+        mascara[self.posicoes(cpfs)] = True
+        return mascara
+
+    def contem_cpf(self, cpf):
+        return (chave_inteira(cpf, largura=11) if self._cpf_inteiro else cpf) in self.posicoes_cpf
+
+    def linhas_cpf(self, cpf):
+        return self.df.iloc[self.posicoes([cpf])]
+
+# _df_input não entra no hash do cache: a chave é a versão do arquivo da base
+@st.cache_resource(show_spinner=False)
+def get_indice_base(_df_input, nome, versao_base):
+    return IndiceBase(_df_input)
+
+with instrumentacao.etapa("indices"):
+    indice_base = get_indice_base(df, "base", versao_base)
+    indice_filtrado = get_indice_base(filtered_common_df, "filtrado", versao_base)
 
 # --- Optimized Calculation of Counts for Menu Items ---
-@st.cache_data
-def calculate_counts(filtered_df, tomb_df, active_cpfs, tombados_set, aguardando_set):
-    # Inconsistencies count
-    merged_df = filtered_df.merge(
-        tomb_df[['CPF Tomador', 'Número Contrato']],
-        left_on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
-        right_on=['CPF Tomador', 'Número Contrato'],
-        how='left',
-        indicator=True
-    )
-    inconsistencias_df = merged_df[merged_df['_merge'] == 'left_only']
+def separar_chaves(conjunto):
+    # {(cpf, contrato), ...} -> (lista de cpfs, lista de contratos)
+    return tuple(map(list, zip(*conjunto))) if conjunto else ([], [])
+
+# Chave do cache: só as versões da base e do snapshot da planilha. DataFrames, conjuntos e índices
+# (prefixo _) não são hasheados, e o resultado é compartilhado entre sessões sem cópia.
+@cache_medido(st.cache_resource, max_entries=4, show_spinner=False)
+def calculate_counts(_filtered_df, _tomb_df, _active_cpfs, _tombados_set, _aguardando_set, _indice_filtrado, _indice_base, versao_base, versao_status):
+    filtered_df, tomb_df = _filtered_df, _tomb_df
+    chaves_tombados = separar_chaves(_tombados_set)
+    chaves_aguardando = separar_chaves(_aguardando_set)
+
+    # Inconsistências: anti-join da base filtrada com o tombamento
+    no_tombamento = _indice_filtrado.mascara_tombamento(tomb_df)
+    inconsistencias_df = filtered_df[~no_tombamento]
     num_inconsistencias = len(inconsistencias_df)
 
-    # Registros Consulta Ativa count
-    # Convert sets to DataFrames for merging if they are large, otherwise list comprehension is fine
-    # For optimization, let's create a temporary DataFrame for faster lookup
-    active_contracts_df = filtered_df[
-        filtered_df['Número CPF/CNPJ'].isin(active_cpfs)
-    ].copy()
-    
-    # Exclude already tombados or aguardando
-    active_contracts_df['temp_key'] = active_contracts_df.apply(lambda r: (r['Número CPF/CNPJ'], r['Número Contrato Crédito']), axis=1)
-    
-    registros_consulta_ativa_df = active_contracts_df[
-        ~active_contracts_df['temp_key'].isin(tombados_set) &
-        ~active_contracts_df['temp_key'].isin(aguardando_set)
-    ].drop(columns=['temp_key'])
+    # Registros Consulta Ativa: CPF ativo e contrato fora de tombados/aguardando
+    registros_consulta_ativa_df = filtered_df[
+        _indice_filtrado.mascara_cpfs(_active_cpfs) &
+        ~_indice_filtrado.mascara(*chaves_tombados) &
+        ~_indice_filtrado.mascara(*chaves_aguardando)
+    ]
     num_consulta_ativa = len(registros_consulta_ativa_df)
 
-
-    # Aguardando Conclusão count
-    #aguardando_df = pd.DataFrame(list(aguardando_set), columns=['Número CPF/CNPJ', 'Número Contrato Crédito'])
-    #merged_aguardando = aguardando_df.merge(
-        #df,
-        #on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
-        #how='inner'
-    #)
-
-    aguardando_df = pd.DataFrame(list(aguardando_set), columns=['Número CPF/CNPJ', 'Número Contrato Crédito'])
-    merged_aguardando = aguardando_df.merge(
-        filtered_df,
-        on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
-        how='left'  # Usa left join para preservar todos os registros aguardando
-    )
-
+    # Aguardando Conclusão: semi-join com a base filtrada mais as chaves sem correspondência,
+    # preservando todos os registros aguardando (equivale ao left join a partir do aguardando)
+    colunas_chave = ['Número CPF/CNPJ', 'Número Contrato Crédito']
+    # As chaves ficam em texto aqui, como vieram da planilha, para juntar com as que não estão na base
+    encontrados = para_exibicao(filtered_df[_indice_filtrado.mascara(*chaves_aguardando)])
+    encontrados = encontrados.assign(**{'Número Contrato Crédito': encontrados['Número Contrato Crédito'].astype(str)})
+    sem_base = ~_indice_filtrado.presentes(*chaves_aguardando)
+    merged_aguardando = pd.concat([
+        encontrados[colunas_chave + [c for c in filtered_df.columns if c not in colunas_chave]],
+        pd.DataFrame({
+            'Número CPF/CNPJ': np.asarray(chaves_aguardando[0], dtype=object)[sem_base],
+            'Número Contrato Crédito': np.asarray(chaves_aguardando[1], dtype=object)[sem_base],
+        }),
+    ], ignore_index=True)
     num_aguardando = len(merged_aguardando)
 
-    # Tombado count
-    tombados_df_temp = pd.DataFrame(list(tombados_set), columns=['Número CPF/CNPJ', 'Número Contrato Crédito'])
-    merged_tombados = tombados_df_temp.merge(
-        df,
-        on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
-        how='inner'
-    )
+    # Tombado: semi-join da base completa com os tombados
+    merged_tombados = _indice_base.df[_indice_base.mascara(*chaves_tombados)]
     num_tombado = len(merged_tombados)
 
     return num_inconsistencias, num_consulta_ativa, num_aguardando, num_tombado, inconsistencias_df, registros_consulta_ativa_df, merged_aguardando, merged_tombados
 
-num_inconsistencias, num_consulta_ativa, num_aguardando, num_tombado, inconsistencias_data, registros_consulta_ativa_data, aguardando_conclusao_data, tombado_data = \
-    calculate_counts(filtered_common_df, tomb, cpfs_ativos, tombados, aguardando)
+with instrumentacao.etapa("contagens"):
+    num_inconsistencias, num_consulta_ativa, num_aguardando, num_tombado, inconsistencias_data, registros_consulta_ativa_data, aguardando_conclusao_data, tombado_data = \
+        calculate_counts(filtered_common_df, tomb, cpfs_ativos, tombados, aguardando, indice_filtrado, indice_base, versao_base, versao_status)
+
+# --- Resumo por consignante materializado ---
+# Montado uma vez por carga da base; a cada nova leitura da planilha só as linhas cujo status
+# mudou (diferença entre os conjuntos) ajustam os totais do grupo. Quando a base é trocada, os
+# status das chaves que já estavam no resumo anterior são aproveitados e só as chaves novas são
+# procuradas nos conjuntos.
+class ResumoConsignante:
+    COLUNAS_GRUPO = ["CNPJ Empresa Consignante", "Empresa Consignante"]
+    STATUS = ["Consulta Ativa", "Tombado", "Aguardando"]
+
+    def __init__(self, filtered_df, tomb_df, anterior=None):
+        registros = filtered_df[['Número CPF/CNPJ', 'Número Contrato Crédito']].merge(
+            tomb_df[['CPF Tomador', 'Número Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante']],
+            left_on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
+            right_on=['CPF Tomador', 'Número Contrato'],
+            how='left'
+        )
+        registros['CNPJ Empresa Consignante'] = preencher_consignante(registros['CNPJ Empresa Consignante'])
+        registros['Empresa Consignante'] = preencher_consignante(registros['Empresa Consignante'])
+        registros = registros.rename(columns={'Número CPF/CNPJ': 'CPF', 'Número Contrato Crédito': 'Contrato'})
+        self.registros = registros[['CPF', 'Contrato'] + self.COLUNAS_GRUPO].reset_index(drop=True)
+        self.indice = IndiceBase(self.registros, 'CPF', 'Contrato')
+
+        self.grupo, grupos = pd.factorize(pd.MultiIndex.from_frame(self.registros[self.COLUNAS_GRUPO]))
+        self.grupos = grupos.to_frame(index=False, name=self.COLUNAS_GRUPO).astype(object)  # ordena por texto, não pela ordem das categorias
+        self.total_cooperados = self.registros.groupby(self.grupo)['CPF'].nunique().to_numpy()
+        self.total_contratos = np.bincount(self.grupo, minlength=len(self.grupos))
+
+        self.flags = {status: np.zeros(len(self.registros), dtype=bool) for status in self.STATUS}
+        self.totais = {status: np.zeros(len(self.grupos), dtype=np.int64) for status in self.STATUS}
+        self._conjuntos = {status: set() for status in self.STATUS}
+        self.versao_status = None
+        self._lock = threading.Lock()
+        if anterior is not None:
+            self._herdar(anterior)
+
+    def _herdar(self, anterior):
+        with anterior._lock:
+            if anterior.versao_status is None:
+                return
+            # Posição de cada chave no resumo anterior; -1 para as inseridas na nova base
+            # (chaves repetidas têm os mesmos status, qualquer uma das posições serve)
+            codigos = anterior.indice.codificar(self.registros['CPF'].to_numpy(), self.registros['Contrato'].to_numpy())
+            unicos = ~anterior.indice.codigos.duplicated()
+            encontrados = anterior.indice.codigos[unicos].get_indexer(codigos)
+            posicoes = np.where(encontrados >= 0, np.flatnonzero(unicos)[encontrados], -1)
+            novas = posicoes < 0
+
+            chaves_novas = para_exibicao(self.registros.loc[novas, ['CPF', 'Contrato']])
+            cpfs, contratos = chaves_novas['CPF'].to_numpy(), chaves_novas['Contrato'].astype(str).to_numpy()
+            for status in self.STATUS:
+                conjunto = anterior._conjuntos[status]
+                self.flags[status][~novas] = anterior.flags[status][posicoes[~novas]]
+                if status == "Consulta Ativa":
+                    self.flags[status][novas] = [cpf in conjunto for cpf in cpfs]
+                else:
+                    self.flags[status][novas] = [chave in conjunto for chave in zip(cpfs, contratos)]
+                self.totais[status] = np.bincount(self.grupo[self.flags[status]], minlength=len(self.grupos))
+                self._conjuntos[status] = conjunto
+            self.versao_status = anterior.versao_status
+
+    def _atualizar(self, status, posicoes, valor):
+        posicoes = np.unique(np.asarray(posicoes, dtype=np.int64))
+        posicoes = posicoes[posicoes >= 0]
+        mudam = posicoes[self.flags[status][posicoes] != valor]
+        self.flags[status][mudam] = valor
+        np.add.at(self.totais[status], self.grupo[mudam], 1 if valor else -1)
+
+    def _posicoes_cpfs(self, cpfs):
+        return self.indice.posicoes(cpfs)
+
+    def _posicoes_contratos(self, chaves):
+        codigos = self.indice.codificar(*separar_chaves(chaves))
+        return self.indice.codigos.get_indexer_for(codigos[codigos >= 0])
+
+    def sincronizar(self, cpfs_ativos, tombados, aguardando, versao_status):
+        with self._lock:
+            if versao_status == self.versao_status:
+                return
+            for status, novo, posicoes in [
+                ("Consulta Ativa", cpfs_ativos, self._posicoes_cpfs),
+                ("Tombado", tombados, self._posicoes_contratos),
+                ("Aguardando", aguardando, self._posicoes_contratos),
+            ]:
+                anterior = self._conjuntos[status]
+                self._atualizar(status, posicoes(novo - anterior), True)
+                self._atualizar(status, posicoes(anterior - novo), False)
+                self._conjuntos[status] = novo
+            self.versao_status = versao_status
+
+    def tabela(self):
+        resumo = self.grupos.assign(
+            Total_Cooperados=self.total_cooperados,
+            Total_Contratos=self.total_contratos,
+            Total_Consulta_Ativa=self.totais["Consulta Ativa"],
+            Total_Tombado=self.totais["Tombado"],
+            Total_Aguardando_Conclusao=self.totais["Aguardando"],
+        )
+        return resumo.sort_values(self.COLUNAS_GRUPO, ignore_index=True)
+
+    def registros_com_status(self):
+        return self.registros.assign(**{status: flags.copy() for status, flags in self.flags.items()})
+
+# Último resumo montado, mantido entre trocas de base para a próxima versão herdar os status
+@st.cache_resource
+def get_ultimo_resumo():
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def get_resumo_consignante(_filtered_df, _tomb_df, versao_base):
+    ultimo = get_ultimo_resumo()
+    resumo = ResumoConsignante(_filtered_df, _tomb_df, ultimo.get("resumo"))
+    ultimo["resumo"] = resumo
+    return resumo
+
+# --- Exportações: o arquivo só é montado quando pedido e fica em cache pela versão dos dados ---
+FORMATOS_EXPORTACAO = {
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/octet-stream"),
+}
+
+# _df_export não entra no hash do cache: a chave é a origem da tabela (chave do exportar_dados) e a
+# versão dos dados que a originaram
+@cache_medido(max_entries=8, show_spinner="Gerando arquivo...")
+def gerar_exportacao(_df_export, formato, nome_aba, chave, versao):
+    _df_export = para_exibicao(_df_export)
+    buffer = io.BytesIO()
+    if formato == "CSV":
+        _df_export.to_csv(buffer, index=False, sep=";", encoding="utf-8-sig")
+    elif formato == "Parquet":
+        normalizar_para_arrow(_df_export.copy()).to_parquet(buffer, index=False)  # ex.: CNPJ numérico com "CONSULTE SISBR"
+    else:
+        # Workbook write-only do openpyxl: as linhas vão direto para o arquivo, sem montar as células em memória
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        planilha = workbook.create_sheet(nome_aba)
+        planilha.append([str(col) for col in _df_export.columns])
+        for linha in _df_export.astype(object).where(_df_export.notna(), None).itertuples(index=False, name=None):
+            planilha.append(linha)
+        workbook.save(buffer)
+    return buffer.getvalue()
+
+def versao_dataframe(df_input):
+    # Para logs pequenos, a própria tabela define a versão: nomes das colunas e hash de cada linha, em ordem
+    digest = hashlib.sha256(repr(tuple(df_input.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df_input, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def exportar_dados(df_export, nome_arquivo, nome_aba, chave, versao, rotulo="📥 Baixar"):
+    formato = st.radio("Formato", list(FORMATOS_EXPORTACAO), horizontal=True, key=f"formato_{chave}")
+    pedido = (versao, formato)
+    if st.button("Gerar arquivo", key=f"gerar_{chave}"):
+        st.session_state[f"exportacao_{chave}"] = pedido
+    if st.session_state.get(f"exportacao_{chave}") == pedido:
+        extensao, mime = FORMATOS_EXPORTACAO[formato]
+        st.download_button(
+            label=f"{rotulo} ({formato})",
+            data=gerar_exportacao(df_export, formato, nome_aba, chave, versao),
+            file_name=f"{nome_arquivo}.{extensao}",
+            mime=mime,
+            key=f"download_{chave}"
+        )
+
+# Log de cada upload processado, guardado na sessão pelo file_id: os reruns seguintes (ex.: "Gerar arquivo"
+# ou troca do formato da exportação) reaproveitam o log em vez de reprocessar um upload já marcado,
+# o que refaria o log inteiro como "já estava marcado"
+def log_do_upload(chave, arquivos):
+    guardado = st.session_state.get(f"log_upload_{chave}")
+    ids = tuple(arquivo.file_id for arquivo in arquivos)
+    return guardado[1] if guardado is not None and guardado[0] == ids else None
+
+def guardar_log_do_upload(chave, arquivos, log):
+    st.session_state[f"log_upload_{chave}"] = (tuple(arquivo.file_id for arquivo in arquivos), log)
+
+# --- Tabelas paginadas no servidor ---
+TAMANHO_PAGINA = 100
+COLUNAS_EXIBICAO = [
+    "Número CPF/CNPJ", "Nome Cliente", "Número Contrato Crédito",
+    "Quantidade Parcelas Abertas", "% Taxa Operação", "Código Linha Crédito", "Nome Comercial"
+]
+
+def filtrar_cpf(df_input, cpf, indice=None):
+    # Com índice, as linhas saem das posições pré-calculadas do CPF; df_input precisa ser um recorte de indice.df
+    if indice is not None:
+        rotulos = indice.df.index[indice.posicoes([cpf])]
+        return df_input[df_input.index.isin(rotulos)]
+    return df_input[df_input['Número CPF/CNPJ'] == cpf]
+
+def paginar(df_input, chave, colunas):
+    # Ordena e fatia no servidor: só a página visível e as colunas de exibição vão para o navegador
+    colunas = [c for c in colunas if c in df_input.columns]
+    total_paginas = max(1, -(-len(df_input) // TAMANHO_PAGINA))
+    if st.session_state.get(f"pagina_{chave}", 1) > total_paginas:
+        st.session_state[f"pagina_{chave}"] = total_paginas
+
+    col_ordem, col_desc, col_pagina = st.columns([2, 1, 1])
+    ordenar_por = col_ordem.selectbox("Ordenar por", ["(ordem original)"] + colunas, key=f"ordem_{chave}")
+    decrescente = col_desc.checkbox("Decrescente", key=f"desc_{chave}")
+    pagina = col_pagina.number_input("Página", min_value=1, max_value=total_paginas, step=1, key=f"pagina_{chave}")
+
+    inicio = (pagina - 1) * TAMANHO_PAGINA
+    if ordenar_por == "(ordem original)":
+        posicoes = np.arange(inicio, min(inicio + TAMANHO_PAGINA, len(df_input)))
+    else:
+        # Ordena só a coluna escolhida e pega as posições da página
+        ordem = df_input[ordenar_por].reset_index(drop=True).sort_values(ascending=not decrescente, kind="stable", na_position="last")
+        posicoes = ordem.index.to_numpy()[inicio:inicio + TAMANHO_PAGINA]
+    st.caption(f"{len(df_input)} registro(s) · página {pagina} de {total_paginas}")
+    return df_input.iloc[posicoes][colunas]
 
 st.sidebar.header("Menu")
 menu_options = [
@@ -267,20 +1447,89 @@ menu_options = [
     "Marcação Consulta em Lote",  # Novo menu 1
     "Marcação Sisbr em Lote",  # Novo menu 3
     "Marcação Tombado em Lote",  # Novo menu 2
+    "Diagnóstico",
     "Atualizar Bases"
 ]
 menu = st.sidebar.radio("Navegação", menu_options)
+tempo_contagens, contagens_calculadas = instrumentacao.ultima_execucao("calculate_counts")
+if tempo_contagens is not None:
+    st.sidebar.caption(f"Contagens calculadas em {tempo_contagens * 1000:.0f} ms" if contagens_calculadas
+                       else f"Contagens do cache (último cálculo: {tempo_contagens * 1000:.0f} ms)")
+idade_status = status_sheets.idade()
+if idade_status is not None:
+    st.sidebar.caption(f"Status da planilha lido há {idade_status:.0f} s" + (" · atualizando..." if status_sheets.atualizando else ""))
+    if status_sheets.erro is not None:
+        st.sidebar.warning(f"Falha ao reler a planilha ({status_sheets.erro}); exibindo a última leitura.")
+if st.sidebar.button("🔄 Reler planilha"):
+    status_sheets.revalidar()
+replicador = get_replicador()
+marcacoes_pendentes = get_estado_local().contar_pendentes()
+if marcacoes_pendentes:
+    st.sidebar.caption(f"📤 {marcacoes_pendentes} alteração(ões) aguardando envio à planilha")
+if replicador.erro is not None:
+    st.sidebar.warning(f"Falha ao enviar marcações à planilha ({replicador.erro}); nova tentativa em instantes.")
+estado_cota = client.http_client.estado()
+if estado_cota["espera_escrita_s"] > 1 or estado_cota["chamadas_em_espera"]:
+    st.sidebar.warning(f"⏳ Cota do Google Sheets no limite: gravações aguardando ~{estado_cota['espera_escrita_s']:.0f} s na fila.")
+instrumentacao.abrir_etapa("página")  # renderização da página escolhida, até o fim do script
 
 if menu == "Atualizar Bases":
     st.session_state.arquivo_novo = st.sidebar.file_uploader("Nova Base NovoEmprestimo.xlsx", type="xlsx")
     st.session_state.arquivo_tomb = st.sidebar.file_uploader("Nova Base Tombamento.xlsx", type="xlsx")
     if st.sidebar.button("Atualizar"):
         if st.session_state.arquivo_novo and st.session_state.arquivo_tomb:
-            salvar_arquivos(st.session_state.arquivo_novo, st.session_state.arquivo_tomb)
+            with st.spinner("Comparando com as bases anteriores..."):
+                mudancas = salvar_arquivos(st.session_state.arquivo_novo, st.session_state.arquivo_tomb)
+            # As contagens de agora viram o "antes" do resumo exibido após o rerun; o resumo vale
+            # só enquanto as bases gravadas aqui forem as atuais
+            st.session_state.mudancas_bases = {
+                "versao_base": versao_das_bases(),
+                "mudancas": mudancas,
+                "contagens_antes": {"Inconsistências": num_inconsistencias, "Consulta Ativa": num_consulta_ativa,
+                                    "Aguardando Conclusão": num_aguardando, "Tombado": num_tombado},
+            }
             st.success("Bases atualizadas.")
             st.rerun() # Rerun to update counts and dataframes
         else:
             st.warning("Envie os dois arquivos para atualizar.")
+
+    if st.session_state.mudancas_bases and st.session_state.mudancas_bases["versao_base"] != versao_base:
+        st.session_state.mudancas_bases = None  # bases trocadas depois (por esta ou outra sessão)
+    if st.session_state.mudancas_bases:
+        st.title("🔄 Mudanças da última atualização")
+        linhas_resumo = []
+        for nome, mudanca in st.session_state.mudancas_bases["mudancas"].items():
+            if mudanca == "igual":
+                linhas_resumo.append({"Base": nome, "Situação": "arquivo idêntico ao anterior"})
+            elif mudanca is None:
+                linhas_resumo.append({"Base": nome, "Situação": "primeira carga"})
+            else:
+                linhas_resumo.append({
+                    "Base": nome, "Situação": "atualizada",
+                    "Linhas antes": mudanca["linhas_antes"], "Linhas depois": mudanca["linhas_depois"],
+                    "Inseridas": len(mudanca["inseridos"]), "Removidas": len(mudanca["removidos"]), "Alteradas": len(mudanca["alterados"]),
+                })
+        st.dataframe(pd.DataFrame(linhas_resumo), use_container_width=True)
+
+        contagens_agora = {"Inconsistências": num_inconsistencias, "Consulta Ativa": num_consulta_ativa,
+                           "Aguardando Conclusão": num_aguardando, "Tombado": num_tombado}
+        st.subheader("Efeito nas contagens")
+        st.dataframe(pd.DataFrame([
+            {"Indicador": indicador, "Antes": antes, "Agora": contagens_agora[indicador], "Diferença": contagens_agora[indicador] - antes}
+            for indicador, antes in st.session_state.mudancas_bases["contagens_antes"].items()
+        ]), use_container_width=True)
+
+        for nome, mudanca in st.session_state.mudancas_bases["mudancas"].items():
+            if not isinstance(mudanca, dict):
+                continue
+            if mudanca["colunas_novas"] or mudanca["colunas_removidas"]:
+                st.warning(f"{nome}: colunas novas {mudanca['colunas_novas']}, removidas {mudanca['colunas_removidas']}")
+            for tipo in ("inseridos", "removidos", "alterados"):
+                if len(mudanca[tipo]):
+                    with st.expander(f"{nome}: {len(mudanca[tipo])} contrato(s) {tipo}"):
+                        st.dataframe(mudanca[tipo].head(TAMANHO_PAGINA), use_container_width=True)
+                        exportar_dados(mudanca[tipo], f"{nome.lower()}_{tipo}", tipo.capitalize(), f"mudancas_{nome}_{tipo}",
+                                       versao_dataframe(mudanca[tipo]), rotulo="📥 Exportar")
     st.stop()
 
 
@@ -299,7 +1548,7 @@ if "Consulta Individual" in menu:
 
         if cpf_validado and len(cpf_validado) == 11 and cpf_validado.isdigit():
             # Use the already filtered common_df
-            filtrado = filtered_common_df[filtered_common_df['Número CPF/CNPJ'] == cpf_validado].copy()
+            filtrado = indice_filtrado.linhas_cpf(cpf_validado)
 
             if filtrado.empty:
                 st.warning("Nenhum contrato encontrado com os filtros aplicados.")
@@ -311,15 +1560,15 @@ if "Consulta Individual" in menu:
                     right_on=['CPF Tomador', 'Número Contrato'],
                     how='left'
                 )
-                resultados_df['Consignante'] = resultados_df['CNPJ Empresa Consignante'].fillna("CONSULTE SISBR")
-                resultados_df['Empresa Consignante'] = resultados_df['Empresa Consignante'].fillna("CONSULTE SISBR")
+                resultados_df['Consignante'] = preencher_consignante(resultados_df['CNPJ Empresa Consignante'])
+                resultados_df['Empresa Consignante'] = preencher_consignante(resultados_df['Empresa Consignante'])
 
                 display_cols = [
                     "Número CPF/CNPJ", "Nome Cliente", "Número Contrato Crédito",
                     "Quantidade Parcelas Abertas", "% Taxa Operação", "Código Linha Crédito",
                     "Nome Comercial", "Consignante", "Empresa Consignante"
                 ]
-                st.dataframe(resultados_df[display_cols])
+                st.dataframe(para_exibicao(resultados_df[display_cols]))
 
                 if cpf_validado in cpfs_ativos:
                     st.info("✅ CPF já marcado como Consulta Ativa.")
@@ -338,20 +1587,19 @@ if "Registros Consulta Ativa" in menu:
     if not registros_consulta_ativa_data.empty:
         cpf_input = st.text_input("Digite o CPF (apenas números):", key="cpf_ca_input").strip()
 
+        tabela = registros_consulta_ativa_data
         if cpf_input and len(cpf_input) == 11:
-            contratos_filtrados = registros_consulta_ativa_data[
-                registros_consulta_ativa_data['Número CPF/CNPJ'] == cpf_input
-            ]['Número Contrato Crédito'].astype(str).tolist()
+            tabela = filtrar_cpf(registros_consulta_ativa_data, cpf_input, indice_filtrado)
+            contratos_filtrados = tabela['Número Contrato Crédito'].astype(str).tolist()
 
             contratos_escolhidos = st.multiselect("Selecione os contratos para marcar:", contratos_filtrados)
 
             if st.button("Marcar como Lançado Sisbr"):
-                for contrato in contratos_escolhidos:
-                    marcar_aguardando(cpf_input, contrato)
+                marcar([("aguardando", (cpf_input, contrato), True) for contrato in contratos_escolhidos])
                 st.success(f"{len(contratos_escolhidos)} contrato(s) marcado(s) como 'Aguardando Conclusão'.")
                 st.rerun()
 
-        st.dataframe(registros_consulta_ativa_data, use_container_width=True)
+        st.dataframe(para_exibicao(paginar(tabela, "consulta_ativa", COLUNAS_EXIBICAO)), use_container_width=True)
     else:
         st.info("Nenhum registro disponível para Consulta Ativa.")
 
@@ -360,48 +1608,17 @@ if menu == "Resumo":
     st.title("📊 Resumo Consolidado por Consignante (Base Completa)")
 
     if not filtered_common_df.empty:
-        # Prepare data for merge and status flags
-        temp_df = filtered_common_df[['Número CPF/CNPJ', 'Número Contrato Crédito']].copy()
-        temp_df['Contrato_Tuple'] = list(zip(temp_df['Número CPF/CNPJ'], temp_df['Número Contrato Crédito']))
-
-        # Add status columns directly
-        temp_df['Consulta Ativa'] = temp_df['Número CPF/CNPJ'].isin(cpfs_ativos)
-        temp_df['Tombado'] = temp_df['Contrato_Tuple'].isin(tombados)
-        temp_df['Aguardando'] = temp_df['Contrato_Tuple'].isin(aguardando)
-
-        # Merge with tomb for consignante info
-        df_registros = temp_df.merge(
-            tomb[['CPF Tomador', 'Número Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante']],
-            left_on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
-            right_on=['CPF Tomador', 'Número Contrato'],
-            how='left'
-        )
-        df_registros['CNPJ Empresa Consignante'] = df_registros['CNPJ Empresa Consignante'].fillna("CONSULTE SISBR")
-        df_registros['Empresa Consignante'] = df_registros['Empresa Consignante'].fillna("CONSULTE SISBR")
-        df_registros = df_registros.rename(columns={'Número CPF/CNPJ': 'CPF', 'Número Contrato Crédito': 'Contrato'})
-
-
-        resumo = df_registros.groupby(["CNPJ Empresa Consignante", "Empresa Consignante"]).agg(
-            Total_Cooperados=("CPF", "nunique"),
-            Total_Contratos=("Contrato", "count"),
-            Total_Consulta_Ativa=("Consulta Ativa", "sum"),
-            Total_Tombado=("Tombado", "sum"),
-            Total_Aguardando_Conclusao=("Aguardando", "sum")
-        ).reset_index()
+        resumo_consignante = get_resumo_consignante(filtered_common_df, tomb, versao_base)
+        resumo_consignante.sincronizar(cpfs_ativos, tombados, aguardando, versao_status)
+        df_registros = resumo_consignante.registros_com_status()
 
-        st.dataframe(resumo)
+        st.dataframe(resumo_consignante.tabela())
 
         with st.expander("📥 Exportar relação analítica"):
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df_registros[['CPF', 'Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante', 'Consulta Ativa', 'Tombado', 'Aguardando']].to_excel(writer, index=False, sheet_name="Relação Analítica")
-                buffer.seek(0)
-                st.download_button(
-                    label="Exportar para Excel",
-                    data=buffer,
-                    file_name="resumo_analitico.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(
+                df_registros[['CPF', 'Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante', 'Consulta Ativa', 'Tombado', 'Aguardando']],
+                "resumo_analitico", "Relação Analítica", "resumo", f"{versao_base}-{versao_status}", rotulo="Exportar"
+            )
     else:
         st.info("Nenhum dado encontrado na base para resumo.")
 
@@ -414,23 +1631,15 @@ if "Inconsistências" in menu:
     else:
         st.warning(f"{len(inconsistencias_data)} contratos sem correspondência no tombamento encontrados.")
         # Only show relevant columns for inconsistencies
-        st.dataframe(inconsistencias_data[
+        st.dataframe(para_exibicao(inconsistencias_data[
             ['Número CPF/CNPJ', 'Número Contrato Crédito', 'Código Linha Crédito', 'Nome Cliente']
-        ])
+        ]))
 
         with st.expander("📥 Exportar inconsistências"):
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    inconsistencias_data[[
-                        'Número CPF/CNPJ', 'Número Contrato Crédito', 'Código Linha Crédito', 'Nome Cliente'
-                    ]].to_excel(writer, index=False, sheet_name="Inconsistencias")
-                buffer.seek(0)
-                st.download_button(
-                    label="Exportar para Excel",
-                    data=buffer,
-                    file_name="inconsistencias_tombamento.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(
+                inconsistencias_data[['Número CPF/CNPJ', 'Número Contrato Crédito', 'Código Linha Crédito', 'Nome Cliente']],
+                "inconsistencias_tombamento", "Inconsistencias", "inconsistencias", versao_base, rotulo="Exportar"
+            )
 
 
 if "Aguardando Conclusão" in menu:
@@ -439,20 +1648,19 @@ if "Aguardando Conclusão" in menu:
     if not aguardando_conclusao_data.empty:
         cpf_input = st.text_input("Digite o CPF (apenas números):", key="cpf_ag_input").strip()
 
+        tabela = aguardando_conclusao_data
         if cpf_input and len(cpf_input) == 11:
-            contratos_filtrados = aguardando_conclusao_data[
-                aguardando_conclusao_data['Número CPF/CNPJ'] == cpf_input
-            ]['Número Contrato Crédito'].astype(str).tolist()
+            tabela = filtrar_cpf(aguardando_conclusao_data, cpf_input)
+            contratos_filtrados = tabela['Número Contrato Crédito'].astype(str).tolist()
 
             contratos_escolhidos = st.multiselect("Selecione os contratos para tombar:", contratos_filtrados)
 
             if st.button("Marcar como Tombado"):
-                for contrato in contratos_escolhidos:
-                    marcar_tombado(cpf_input, contrato)
+                marcar([alteracao for contrato in contratos_escolhidos for alteracao in alteracoes_tombado(cpf_input, contrato)])
                 st.success(f"{len(contratos_escolhidos)} contrato(s) tombado(s) com sucesso.")
                 st.rerun()
 
-        st.dataframe(aguardando_conclusao_data, use_container_width=True)
+        st.dataframe(paginar(tabela, "aguardando", COLUNAS_EXIBICAO), use_container_width=True)
     else:
         st.info("Nenhum registro encontrado.")
 
@@ -461,22 +1669,23 @@ if "Tombado" in menu:
     st.title(f"📁 Registros Tombados ({num_tombado})")
 
     if not tombado_data.empty:
-        # Merge with tomb for consignante info for display
-        df_resultado = tombado_data.merge(
+        cpf_input = st.text_input("Buscar CPF (apenas números):", key="cpf_tomb_input").strip()
+        tabela = tombado_data
+        if cpf_input and len(cpf_input) == 11:
+            tabela = filtrar_cpf(tombado_data, cpf_input, indice_base)
+
+        # Merge with tomb for consignante info, only for the visible page
+        df_resultado = paginar(tabela, "tombado", COLUNAS_EXIBICAO).merge(
             tomb[['CPF Tomador', 'Número Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante']],
             left_on=['Número CPF/CNPJ', 'Número Contrato Crédito'],
             right_on=['CPF Tomador', 'Número Contrato'],
             how='left'
         )
-        df_resultado['Consignante'] = df_resultado['CNPJ Empresa Consignante'].fillna("CONSULTE SISBR")
-        df_resultado['Empresa Consignante'] = df_resultado['Empresa Consignante'].fillna("CONSULTE SISBR")
+        df_resultado['Consignante'] = preencher_consignante(df_resultado['CNPJ Empresa Consignante'])
+        df_resultado['Empresa Consignante'] = preencher_consignante(df_resultado['Empresa Consignante'])
 
-        display_cols_tomb = [
-            "Número CPF/CNPJ", "Nome Cliente", "Número Contrato Crédito",
-            "Quantidade Parcelas Abertas", "% Taxa Operação", "Código Linha Crédito",
-            "Nome Comercial", "Consignante", "Empresa Consignante"
-        ]
-        st.dataframe(df_resultado[display_cols_tomb], use_container_width=True)
+        display_cols_tomb = COLUNAS_EXIBICAO + ["Consignante", "Empresa Consignante"]
+        st.dataframe(para_exibicao(df_resultado[display_cols_tomb]), use_container_width=True)
 
     else:
         st.info("Nenhum contrato marcado como tombado encontrado.")
@@ -493,25 +1702,314 @@ def validar_cpf(cpf):
             return False
     return True
 
-def tentar_corrigir_cpf(cpf_raw):
-    # Tenta substituir dígitos comuns de erro e revalidar
-    substituicoes = {'1': '4', '4': '1'}
-    for i, c in enumerate(cpf_raw):
-        if c in substituicoes:
-            corrigido = cpf_raw[:i] + substituicoes[c] + cpf_raw[i+1:]
-            if validar_cpf(corrigido):
-                return corrigido
-    return None
+MOTIVO_CPF_OK = "ok"
+MOTIVO_CPF_TAMANHO = "não tem 11 dígitos"
+MOTIVO_CPF_REPETIDO = "dígitos repetidos"
+MOTIVO_CPF_DV = "dígito verificador incorreto"
+PESOS_DV1 = np.arange(10, 1, -1)
+PESOS_DV2 = np.arange(11, 1, -1)
+
+def validar_cpfs(cpfs):
+    # Versão vetorizada de validar_cpf para Series/arrays de CPFs já limpos (só dígitos).
+    # Retorna a máscara de válidos e o motivo de cada CPF (MOTIVO_CPF_*).
+    textos = pd.Series(cpfs, dtype=object).astype(str).to_numpy()
+    n = len(textos)
+    motivos = np.full(n, MOTIVO_CPF_OK, dtype=object)
+    formato_ok = np.fromiter((len(c) == 11 and c.isdigit() for c in textos), dtype=bool, count=n)
+    motivos[~formato_ok] = MOTIVO_CPF_TAMANHO
+
+    if formato_ok.any():
+        # Cada caractere '<U11' ocupa 4 bytes: a matriz n x 11 sai direto do buffer
+        digitos = np.frombuffer(textos[formato_ok].astype("<U11").tobytes(), dtype="<u4").reshape(-1, 11).astype(np.int64) - 48
+        repetido = (digitos == digitos[:, :1]).all(axis=1)
+        dv1 = ((digitos[:, :9] @ PESOS_DV1) * 10 % 11) % 10
+        dv2 = ((digitos[:, :10] @ PESOS_DV2) * 10 % 11) % 10
+        dv_errado = (dv1 != digitos[:, 9]) | (dv2 != digitos[:, 10])
+
+        motivos_validos = np.where(repetido, MOTIVO_CPF_REPETIDO, np.where(dv_errado, MOTIVO_CPF_DV, MOTIVO_CPF_OK)).astype(object)
+        motivos[formato_ok] = motivos_validos
+
+    return motivos == MOTIVO_CPF_OK, motivos
+
+# Trocas típicas do OCR entre dígitos e o peso relativo de cada uma (quanto maior, mais provável)
+CONFUSOES_OCR = {
+    '1': {'4': 0.6, '7': 0.5},
+    '4': {'1': 0.6},
+    '7': {'1': 0.5},
+    '0': {'8': 0.5, '6': 0.4, '9': 0.2},
+    '8': {'0': 0.5, '6': 0.4, '3': 0.3, '9': 0.2},
+    '6': {'5': 0.4, '0': 0.4, '8': 0.4},
+    '5': {'6': 0.4, '3': 0.3},
+    '3': {'8': 0.3, '5': 0.3},
+    '9': {'0': 0.2, '8': 0.2},
+}
+
+def variantes_cpf(cpf, confianca, max_trocas=2):
+    # Variantes do CPF lido com até max_trocas substituições da matriz de confusão, da mais
+    # provável para a menos. Cada troca pesa peso * (1 - conf) / conf: quanto menor a confiança
+    # do OCR na leitura, mais barato é trocar dígitos.
+    razao = max(1 - confianca, 0.01) / max(confianca, 0.01)
+    opcoes = [(i, digito, peso) for i, c in enumerate(cpf) for digito, peso in CONFUSOES_OCR.get(c, {}).items()]
+    variantes = {}
+    for trocas in range(1, max_trocas + 1):
+        for combinacao in itertools.combinations(opcoes, trocas):
+            if len({i for i, _, _ in combinacao}) < trocas:
+                continue
+            caracteres = list(cpf)
+            pontuacao = 1.0
+            for i, digito, peso in combinacao:
+                caracteres[i] = digito
+                pontuacao *= peso * razao
+            variante = "".join(caracteres)
+            variantes[variante] = max(variantes.get(variante, 0.0), pontuacao)
+    return sorted(variantes.items(), key=lambda item: -item[1])
+
+CONFIANCA_OCR_ALTA = 0.9
+
+def tentar_corrigir_cpf(cpf_raw, confianca, indice):
+    # Candidatos válidos e presentes na base, em ordem de probabilidade. Mais de um candidato
+    # significa leitura ambígua: quem chama deve reportar em vez de marcar.
+    # Um CPF com dígitos verificadores corretos lido com confiança alta é outra pessoa, não um erro
+    # de leitura: não é corrigido (fora da base, fica como não encontrado). Abaixo disso, leituras
+    # com confiança alta só admitem uma troca.
+    if len(cpf_raw) != 11:
+        return []
+    if confianca >= CONFIANCA_OCR_ALTA and validar_cpf(cpf_raw):
+        return []
+    ranking = variantes_cpf(cpf_raw, confianca, max_trocas=1 if confianca >= CONFIANCA_OCR_ALTA else 2)
+    if not ranking:
+        return []
+    validos, _ = validar_cpfs([variante for variante, _ in ranking])
+    return [variante for (variante, _), valido in zip(ranking, validos) if valido and indice.contem_cpf(variante)]
+
+# Reader do EasyOCR compartilhado pelo processo e criado só no primeiro uso:
+# o import do easyocr (e do torch) fica fora dos reruns das outras páginas.
+class LeitorOCR:
+    def __init__(self):
+        self._reader = None
+        self._lock = threading.Lock()
+        self._aquecimento = None
+        # O torch já usa todos os núcleos em cada inferência; mais de uma ao mesmo tempo só disputa CPU
+        self._lock_inferencia = threading.Lock()
+
+    @contextmanager
+    def inferencia(self):
+        with self._lock_inferencia:
+            yield self.obter()
+
+    def obter(self):
+        with self._lock:
+            if self._reader is None:
+                import easyocr
+                os.environ["EASYOCR_MODEL_STORAGE_DIR"] = "./.easyocr"
+                self._reader = easyocr.Reader(['pt'], gpu=False)
+            return self._reader
+
+    def carregado(self):
+        return self._reader is not None
+
+    def aquecer(self):
+        # Carrega o modelo em segundo plano (uma única vez por processo)
+        with self._lock:
+            if self._reader is None and self._aquecimento is None:
+                self._aquecimento = threading.Thread(target=self.obter, daemon=True)
+                self._aquecimento.start()
 
-# Inicializar o reader do EasyOCR uma vez (movido para o escopo global)
-os.environ["EASYOCR_MODEL_STORAGE_DIR"] = "./.easyocr"
-reader = easyocr.Reader(['pt'], gpu=False)
+@st.cache_resource
+def get_leitor_ocr():
+    return LeitorOCR()
+
+# OCR_PRE_CARREGAR=1 aquece o modelo assim que o app sobe, sem esperar a página "Imagens"
+if os.environ.get("OCR_PRE_CARREGAR") == "1":
+    get_leitor_ocr().aquecer()
+
+# Entra na chave do cache: mudar a config (ou a versão do pré-processamento) invalida os resultados
+OCR_CONFIG = {
+    "idiomas": ["pt"],
+    "gpu": False,
+    "dpi_alvo": 150,
+    "max_lado": 2000,
+    "max_inclinacao": 10,  # ângulos maiores que isso em prints costumam ser erro do determine_skew
+    "allowlist": "0123456789.-",
+    "versao_preprocessamento": 1,
+}
+PADRAO_CPF = r'\d{3}\.\d{3}\.\d{3}-\d{2}'
+OCR_CACHE_DIR = os.path.join(DATA_DIR, "ocr_cache")
+OCR_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Cache em disco do resultado bruto do OCR (caixas com texto e confiança), chaveado pelo hash
+# dos bytes da imagem e da configuração. Eviction LRU pelo mtime, que é atualizado a cada leitura.
+class CacheOCR:
+    def __init__(self, diretorio=OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.diretorio = diretorio
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(diretorio, exist_ok=True)
+
+    def chave(self, conteudo):
+        config = json.dumps(OCR_CONFIG, sort_keys=True).encode()
+        return hashlib.sha256(conteudo + config).hexdigest()
+
+    def _caminho(self, chave):
+        return os.path.join(self.diretorio, f"{chave}.json")
+
+    def contem(self, chave):
+        return os.path.exists(self._caminho(chave))
+
+    def ler(self, chave):
+        caminho = self._caminho(chave)
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                caixas = json.load(f)
+            os.utime(caminho)
+            return caixas
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def gravar(self, chave, caixas):
+        caminho = self._caminho(chave)
+        temporario = f"{caminho}.{threading.get_ident()}.tmp"
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(caixas, f)
+        os.replace(temporario, caminho)
+        self._evictar()
+
+    def _evictar(self):
+        with self._lock:
+            arquivos = []
+            for entrada in os.scandir(self.diretorio):
+                if entrada.name.endswith(".json"):
+                    try:
+                        info = entrada.stat()
+                    except FileNotFoundError:
+                        continue
+                    arquivos.append((info.st_mtime, info.st_size, entrada.path))
+            total = sum(tamanho for _, tamanho, _ in arquivos)
+            for _, tamanho, caminho in sorted(arquivos):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+                total -= tamanho
 
-def extrair_cpfs_de_imagem(imagem):
-    imagem_np = np.array(imagem)
-    result = reader.readtext(imagem_np)
-    texto = " ".join([res[1] for res in result])
-    return re.findall(r'\d{3}\.\d{3}\.\d{3}-\d{2}', texto)
+@st.cache_resource
+def get_cache_ocr():
+    return CacheOCR()
+
+def preprocessar_imagem(imagem):
+    # Reduz para o DPI alvo, converte para cinza, corrige a inclinação e binariza (Otsu).
+    # OpenCV e deskew são importados aqui pelo mesmo motivo do easyocr: só a página "Imagens" usa.
+    import cv2
+    from deskew import determine_skew
+
+    dpi = (imagem.info.get("dpi") or (96, 96))[0] or 96
+    escala = min(1.0, OCR_CONFIG["dpi_alvo"] / dpi, OCR_CONFIG["max_lado"] / max(imagem.size))
+    cinza = cv2.cvtColor(np.array(imagem.convert("RGB")), cv2.COLOR_RGB2GRAY)
+    if escala < 1.0:
+        cinza = cv2.resize(cinza, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA)
+
+    angulo = determine_skew(cinza)
+    if angulo is not None and 0.5 < abs(angulo) <= OCR_CONFIG["max_inclinacao"]:
+        altura, largura = cinza.shape
+        matriz = cv2.getRotationMatrix2D((largura / 2, altura / 2), angulo, 1.0)
+        cinza = cv2.warpAffine(cinza, matriz, (largura, altura), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+    _, binaria = cv2.threshold(cinza, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return cinza, binaria
+
+def regioes_candidatas(binaria):
+    # Blobs de texto com o formato de um "ddd.ddd.ddd-dd": uma palavra curta, bem mais larga que alta.
+    # Saída no formato horizontal_list do EasyOCR: [x_min, x_max, y_min, y_max]
+    import cv2
+
+    texto = binaria if binaria.mean() < 127 else 255 - binaria  # texto em branco sobre fundo preto
+
+    # Dilata na horizontal em ~uma altura de caractere (mediana dos componentes conexos),
+    # o suficiente para unir dígitos e pontuação de um mesmo token
+    _, _, stats, _ = cv2.connectedComponentsWithStats(texto)
+    alturas = stats[1:, cv2.CC_STAT_HEIGHT]
+    altura_char = int(np.median(alturas[alturas >= 4])) if (alturas >= 4).any() else 10
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, altura_char), 3))
+    unido = cv2.dilate(texto, kernel)
+    contornos, _ = cv2.findContours(unido, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    altura_img, largura_img = binaria.shape
+    regioes = []
+    for contorno in contornos:
+        x, y, largura, altura = cv2.boundingRect(contorno)
+        if 8 <= altura <= 80 and 5 <= largura / altura <= 20:
+            margem = max(2, altura // 4)
+            regioes.append([max(0, x - margem), min(largura_img, x + largura + margem),
+                            max(0, y - margem), min(altura_img, y + altura + margem)])
+    return regioes
+
+def reconhecer_texto(imagem):
+    # Reconhece só os recortes com cara de CPF, restrito a dígitos e pontuação; se nenhum
+    # recorte render um CPF, cai para detecção + reconhecimento na imagem inteira.
+    # Caixas em formato serializável: [[bbox, texto, confiança], ...]
+    # O pré-processamento (OpenCV, fora do GIL) roda em paralelo; a inferência, uma imagem por vez
+    cinza, binaria = preprocessar_imagem(imagem)
+    regioes = regioes_candidatas(binaria)
+
+    resultado = []
+    with get_leitor_ocr().inferencia() as leitor:
+        if regioes:
+            resultado = leitor.recognize(cinza, horizontal_list=regioes, free_list=[], allowlist=OCR_CONFIG["allowlist"], batch_size=8)
+        if not any(re.search(PADRAO_CPF, texto) for _, texto, _ in resultado):
+            resultado = leitor.readtext(cinza, allowlist=OCR_CONFIG["allowlist"], batch_size=8)
+    return [[[[float(x), float(y)] for x, y in bbox], texto, float(conf)] for bbox, texto, conf in resultado]
+
+def extrair_cpfs_de_caixas(caixas):
+    # [(cpf_raw, confiança)]; um CPF que atravessa caixas fica com a menor confiança entre elas
+    texto, limites = "", []
+    for _, texto_caixa, confianca in caixas:
+        inicio = len(texto) + (1 if texto else 0)
+        texto = f"{texto} {texto_caixa}" if texto else texto_caixa
+        limites.append((inicio, len(texto), confianca))
+    encontrados = []
+    for match in re.finditer(PADRAO_CPF, texto):
+        confs = [conf for inicio, fim, conf in limites if inicio < match.end() and match.start() < fim]
+        encontrados.append((match.group(), min(confs) if confs else 0.0))
+    return encontrados
+
+OCR_WORKERS = max(1, min(4, os.cpu_count() or 1))  # decodificação e pré-processamento; a inferência é serializada
+
+def ocr_conteudo(conteudo):
+    # Reenvios da mesma imagem (ex.: rerun com os arquivos ainda no uploader) não passam pelo OCR
+    cache = get_cache_ocr()
+    chave = cache.chave(conteudo)
+    caixas = cache.ler(chave)
+    if caixas is None:
+        caixas = reconhecer_texto(Image.open(io.BytesIO(conteudo)))
+        cache.gravar(chave, caixas)
+    return extrair_cpfs_de_caixas(caixas)
+
+def processar_imagens_em_paralelo(arquivos, max_workers=OCR_WORKERS, max_em_andamento=None):
+    # Decodifica e pré-processa as imagens em um pool de threads (o reconhecimento entra uma de cada vez,
+    # ver LeitorOCR.inferencia) e devolve (arquivo, cpfs, erro) na ordem em que terminam. Só max_em_andamento imagens ficam carregadas ao mesmo tempo.
+    max_em_andamento = max_em_andamento or 2 * max_workers
+    arquivos = iter(arquivos)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        em_andamento = {}
+
+        def submeter_proximo():
+            arquivo = next(arquivos, None)
+            if arquivo is not None:
+                em_andamento[pool.submit(ocr_conteudo, arquivo.getvalue())] = arquivo
+
+        for _ in range(max_em_andamento):
+            submeter_proximo()
+        while em_andamento:
+            concluidos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+            for futuro in concluidos:
+                arquivo = em_andamento.pop(futuro)
+                submeter_proximo()
+                try:
+                    yield arquivo, futuro.result(), None
+                except Exception as e:
+                    yield arquivo, [], e
 
 
 if "Imagens" in menu:
@@ -519,56 +2017,140 @@ if "Imagens" in menu:
     imagens = st.file_uploader("Envie uma ou mais imagens contendo CPFs", type=["png", "jpg", "jpeg"], accept_multiple_files=True)
 
     if imagens:
-        resultados = []
-        for img_file in imagens:
-            try:
-                imagem = Image.open(img_file)
-                cpfs_extraidos = extrair_cpfs_de_imagem(imagem)
-
-                for cpf_raw in cpfs_extraidos:
+        resultados = log_do_upload("imagens", imagens)
+        if resultados is None:
+            cache_ocr = get_cache_ocr()
+            todas_em_cache = all(cache_ocr.contem(cache_ocr.chave(img_file.getvalue())) for img_file in imagens)
+            if not todas_em_cache and not get_leitor_ocr().carregado():
+                with st.spinner("Carregando modelo de OCR..."):
+                    get_leitor_ocr().obter()
+            resultados = []
+            alteracoes = []  # gravadas no estado local numa única transação ao final
+            marcados = set()  # evita marcar o mesmo CPF de novo quando aparece em várias imagens
+            progresso = st.progress(0.0, text="Processando imagens...")
+            log_parcial = st.empty()
+
+            def registrar(cpf, descricao, msg_marcado, msg_ja_marcado):
+                if cpf in cpfs_ativos or cpf in marcados:
+                    resultados.append((descricao, msg_ja_marcado))
+                else:
+                    alteracoes.append(("ativos", cpf, True))
+                    marcados.add(cpf)
+                    resultados.append((descricao, msg_marcado))
+
+            instrumentacao.abrir_etapa("ocr")
+            for concluidas, (img_file, cpfs_extraidos, erro) in enumerate(processar_imagens_em_paralelo(imagens), start=1):
+                if erro is not None:
+                    resultados.append((img_file.name, f"Erro ao processar imagem: {erro}"))
+                for cpf_raw, confianca in cpfs_extraidos:
                     cpf = re.sub(r'\D', '', cpf_raw)
-                    if len(cpf) != 11 or not validar_cpf(cpf):
-                        cpf_corrigido = tentar_corrigir_cpf(cpf)
-                        if cpf_corrigido and cpf_corrigido in df['Número CPF/CNPJ'].values:
-                            if cpf_corrigido not in cpfs_ativos:
-                                marcar_cpf_ativo(cpf_corrigido)
-                                resultados.append((cpf_raw + f" ➜ {cpf_corrigido}", "✅ Corrigido e marcado"))
-                            else:
-                                resultados.append((cpf_raw + f" ➜ {cpf_corrigido}", "ℹ️ Corrigido, já estava marcado"))
-                        else:
-                            resultados.append((cpf_raw, "❌ CPF inválido ou não encontrado"))
+                    if validar_cpf(cpf) and indice_base.contem_cpf(cpf):
+                        registrar(cpf, cpf_raw, "✅ Marcado com sucesso", "ℹ️ Já estava marcado")
                         continue
 
-                    if cpf in df['Número CPF/CNPJ'].values:
-                        if cpf not in cpfs_ativos:
-                            marcar_cpf_ativo(cpf)
-                            resultados.append((cpf_raw, "✅ Marcado com sucesso"))
-                        else:
-                            resultados.append((cpf_raw, "ℹ️ Já estava marcado"))
-                    else:
+                    # Inválido ou fora da base: tenta as variantes mais prováveis da leitura
+                    candidatos = tentar_corrigir_cpf(cpf, confianca, indice_base)
+                    if len(candidatos) == 1:
+                        registrar(candidatos[0], cpf_raw + f" ➜ {candidatos[0]}", "✅ Corrigido e marcado", "ℹ️ Corrigido, já estava marcado")
+                    elif candidatos:
+                        resultados.append((cpf_raw + " ➜ " + " / ".join(candidatos[:3]), "⚠️ Correção ambígua, confira manualmente"))
+                    elif validar_cpf(cpf):
                         resultados.append((cpf_raw, "❌ CPF não encontrado na base"))
-            except Exception as e:
-                resultados.append((img_file.name, f"Erro ao processar imagem: {e}"))
+                    else:
+                        resultados.append((cpf_raw, "❌ CPF inválido ou não encontrado"))
+
+                progresso.progress(concluidas / len(imagens), text=f"{concluidas}/{len(imagens)} imagens processadas")
+                if resultados:
+                    log_parcial.dataframe(pd.DataFrame(resultados, columns=["CPF", "Status"]), use_container_width=True)
+
+            instrumentacao.fechar_etapa("ocr")
+
+            if alteracoes:
+                marcar(alteracoes)
+            log_parcial.empty()
+            progresso.empty()
+
+            guardar_log_do_upload("imagens", imagens, resultados)
 
         if resultados:
             st.subheader("📄 Log de Processamento")
             df_resultados = pd.DataFrame(resultados, columns=["CPF", "Status"])
             st.dataframe(df_resultados, use_container_width=True)
 
-            # Correção para o ValueError: Obtenha o valor binário do buffer
-            excel_data = None
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df_resultados.to_excel(writer, index=False, sheet_name="Log")
-                excel_data = buffer.getvalue() # Obtenha o conteúdo binário
-
-            if excel_data: # Verifique se há dados antes de tentar baixar
-                st.download_button(
-                    label="📥 Baixar log em Excel",
-                    data=excel_data, # Passe os bytes diretamente
-                    file_name="log_cpfs_imagem.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(df_resultados, "log_cpfs_imagem", "Log", "log_imagens", versao_dataframe(df_resultados), rotulo="📥 Baixar log")
+
+# Loops das marcações em lote, fora das páginas para poderem ser medidos isoladamente (benchmarks/)
+def processar_lote_consulta(lista_cpfs, indice, cpfs_ativos):
+    validos, motivos = validar_cpfs(lista_cpfs)
+
+    log = []
+    alteracoes = []  # gravadas no estado local numa única transação ao final
+    for cpf, valido, motivo in zip(lista_cpfs, validos, motivos):
+        if not valido:
+            log.append((cpf, f"❌ CPF inválido ({motivo})"))
+            continue
+        if not indice.contem_cpf(cpf):
+            log.append((cpf, "❌ CPF não encontrado na base"))
+            continue
+        if cpf in cpfs_ativos:
+            log.append((cpf, "ℹ️ Já estava marcado"))
+            continue
+        alteracoes.append(("ativos", cpf, True))
+        log.append((cpf, "✅ Marcado com sucesso"))
+
+    if alteracoes:
+        marcar(alteracoes)
+    return log
+
+def processar_lote_tombado(cpfs, contratos, tombados, aguardando):
+    validos, motivos = validar_cpfs(cpfs)
+
+    log = []
+    alteracoes = []  # gravadas no estado local numa única transação ao final
+    tombados_lote = set()
+    for cpf, contrato, valido, motivo in zip(cpfs, contratos, validos, motivos):
+        chave = (cpf, contrato)
+
+        if not valido:
+            log.append((cpf, contrato, f"❌ CPF inválido ({motivo})"))
+            continue
+        if chave in tombados or chave in tombados_lote:
+            log.append((cpf, contrato, "ℹ️ Já está tombado"))
+        elif chave in aguardando:
+            alteracoes.extend(alteracoes_tombado(cpf, contrato))
+            tombados_lote.add(chave)
+            log.append((cpf, contrato, "✅ Marcado como Tombado"))
+        else:
+            log.append((cpf, contrato, "❌ Não encontrado na lista de aguardando"))
+
+    if alteracoes:
+        marcar(alteracoes)
+    return log
+
+def processar_lote_sisbr(cpfs, contratos, tombados, aguardando):
+    validos, motivos = validar_cpfs(cpfs)
+
+    log = []
+    alteracoes = []  # gravadas no estado local numa única transação ao final
+    marcados_lote = set()
+    for cpf, contrato, valido, motivo in zip(cpfs, contratos, validos, motivos):
+        chave = (cpf, contrato)
+
+        if not valido:
+            log.append((cpf, contrato, f"❌ CPF inválido ({motivo})"))
+            continue
+        if chave in aguardando or chave in marcados_lote:
+            log.append((cpf, contrato, "ℹ️ Já está como Aguardando"))
+        elif chave in tombados:
+            log.append((cpf, contrato, "❌ Contrato já tombado"))
+        else:
+            alteracoes.append(("aguardando", (cpf, contrato), True))
+            marcados_lote.add(chave)
+            log.append((cpf, contrato, "✅ Marcado como Lançado Sisbr"))
+
+    if alteracoes:
+        marcar(alteracoes)
+    return log
 
 if menu == "Marcação Consulta em Lote":
     st.title("📂 Marcação em Lote de Consulta Ativa")
@@ -599,34 +2181,16 @@ if menu == "Marcação Consulta em Lote":
             df_lote[col_cpf] = df_lote[col_cpf].astype(str).str.replace(r'\D', '', regex=True).str.zfill(11)
             lista_cpfs = df_lote[col_cpf].unique()
 
-            log = []
-            for cpf in lista_cpfs:
-                if not validar_cpf(cpf):
-                    log.append((cpf, "❌ CPF inválido"))
-                    continue
-                if cpf not in df['Número CPF/CNPJ'].values:
-                    log.append((cpf, "❌ CPF não encontrado na base"))
-                    continue
-                if cpf in cpfs_ativos:
-                    log.append((cpf, "ℹ️ Já estava marcado"))
-                    continue
-                marcar_cpf_ativo(cpf)
-                log.append((cpf, "✅ Marcado com sucesso"))
+            log = log_do_upload("consulta", [arquivo_lote])
+            if log is None:
+                log = processar_lote_consulta(lista_cpfs, indice_base, cpfs_ativos)
+                guardar_log_do_upload("consulta", [arquivo_lote], log)
 
             df_log = pd.DataFrame(log, columns=["CPF", "Status"])
             st.success(f"{sum(1 for _, status in log if '✅' in status)} CPFs marcados com sucesso.")
             st.dataframe(df_log, use_container_width=True)
 
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df_log.to_excel(writer, index=False, sheet_name="Log Marcação Lote")
-                buffer.seek(0)
-                st.download_button(
-                    label="📥 Baixar log em Excel",
-                    data=buffer,
-                    file_name="log_marcacao_lote.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(df_log, "log_marcacao_lote", "Log Marcação Lote", "log_lote_consulta", versao_dataframe(df_log), rotulo="📥 Baixar log")
 
         except Exception as e:
             st.error(f"Erro ao processar o arquivo: {e}")
@@ -659,37 +2223,16 @@ if menu == "Marcação Tombado em Lote":
             df_lote[col_cpf] = df_lote[col_cpf].astype(str).str.replace(r'\D', '', regex=True).str.zfill(11)
             df_lote[col_contrato] = df_lote[col_contrato].astype(str).str.strip()
 
-            log = []
-            for _, row in df_lote.iterrows():
-                cpf = row[col_cpf]
-                contrato = row[col_contrato]
-                chave = (cpf, contrato)
-
-                if not validar_cpf(cpf):
-                    log.append((cpf, contrato, "❌ CPF inválido"))
-                    continue
-                if chave in tombados:
-                    log.append((cpf, contrato, "ℹ️ Já está tombado"))
-                elif chave in aguardando:
-                    marcar_tombado(cpf, contrato)
-                    log.append((cpf, contrato, "✅ Marcado como Tombado"))
-                else:
-                    log.append((cpf, contrato, "❌ Não encontrado na lista de aguardando"))
+            log = log_do_upload("tombado", [arquivo_tomb_lote])
+            if log is None:
+                log = processar_lote_tombado(df_lote[col_cpf], df_lote[col_contrato], tombados, aguardando)
+                guardar_log_do_upload("tombado", [arquivo_tomb_lote], log)
 
             st.success(f"{sum(1 for _, _, status in log if '✅' in status)} marcações feitas com sucesso.")
             df_log = pd.DataFrame(log, columns=["CPF", "Contrato", "Status"])
             st.dataframe(df_log, use_container_width=True)
 
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df_log.to_excel(writer, index=False, sheet_name="Log Tombado Lote")
-                buffer.seek(0)
-                st.download_button(
-                    label="📅 Baixar log em Excel",
-                    data=buffer,
-                    file_name="log_tombado_lote.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(df_log, "log_tombado_lote", "Log Tombado Lote", "log_lote_tombado", versao_dataframe(df_log), rotulo="📅 Baixar log")
         except Exception as e:
             st.error(f"Erro ao processar o arquivo: {e}")
 
@@ -720,36 +2263,82 @@ if menu == "Marcação Sisbr em Lote":
             df_lote[col_cpf] = df_lote[col_cpf].astype(str).str.replace(r'\D', '', regex=True).str.zfill(11)
             df_lote[col_contrato] = df_lote[col_contrato].astype(str).str.strip()
 
-            log = []
-            for _, row in df_lote.iterrows():
-                cpf = row[col_cpf]
-                contrato = row[col_contrato]
-                chave = (cpf, contrato)
-
-                if not validar_cpf(cpf):
-                    log.append((cpf, contrato, "❌ CPF inválido"))
-                    continue
-                if chave in aguardando:
-                    log.append((cpf, contrato, "ℹ️ Já está como Aguardando"))
-                elif chave in tombados:
-                    log.append((cpf, contrato, "❌ Contrato já tombado"))
-                else:
-                    marcar_aguardando(cpf, contrato)
-                    log.append((cpf, contrato, "✅ Marcado como Lançado Sisbr"))
+            log = log_do_upload("sisbr", [arquivo_sisbr_lote])
+            if log is None:
+                log = processar_lote_sisbr(df_lote[col_cpf], df_lote[col_contrato], tombados, aguardando)
+                guardar_log_do_upload("sisbr", [arquivo_sisbr_lote], log)
 
             st.success(f"{sum(1 for _, _, status in log if '✅' in status)} marcações feitas com sucesso.")
             df_log = pd.DataFrame(log, columns=["CPF", "Contrato", "Status"])
             st.dataframe(df_log, use_container_width=True)
 
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df_log.to_excel(writer, index=False, sheet_name="Log Sisbr Lote")
-                buffer.seek(0)
-                st.download_button(
-                    label="📅 Baixar log em Excel",
-                    data=buffer,
-                    file_name="log_sisbr_lote.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            exportar_dados(df_log, "log_sisbr_lote", "Log Sisbr Lote", "log_lote_sisbr", versao_dataframe(df_log), rotulo="📅 Baixar log")
         except Exception as e:
             st.error(f"Erro ao processar o arquivo: {e}")
+
+if menu == "Diagnóstico":
+    st.title("🩺 Diagnóstico de Desempenho")
+
+    st.subheader("⏱️ Tempo por etapa das execuções")
+    execucoes = instrumentacao.tabela_execucoes()
+    if execucoes.empty:
+        st.info("Nenhuma execução concluída registrada ainda.")
+    else:
+        colunas_etapas = [c for c in execucoes.columns if c.endswith("(ms)")]
+        st.dataframe(execucoes[colunas_etapas].describe(percentiles=[0.5, 0.95]).T[["count", "mean", "50%", "95%", "max"]].round(1), use_container_width=True)
+        st.dataframe(execucoes.round(1), use_container_width=True)
+
+    st.subheader("☁️ Chamadas à API do Google Sheets")
+    chamadas = instrumentacao.tabela_sheets()
+    if chamadas.empty:
+        st.info("Nenhuma chamada registrada ainda.")
+    else:
+        st.dataframe(chamadas, use_container_width=True)
+
+    st.subheader("🚦 Cota do Google Sheets")
+    estado_cota = client.http_client.estado()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Espera atual para gravar", f"{estado_cota['espera_escrita_s']:.1f} s")
+    col2.metric("Espera média (último minuto)", f"{estado_cota['espera_media_60s']:.2f} s")
+    col3.metric("Chamadas aguardando", estado_cota["chamadas_em_espera"])
+    st.caption(f"{estado_cota['repeticoes']} repetição(ões) após 429/5xx · {estado_cota['leituras_agrupadas']} leitura(s) agrupada(s) com outra idêntica em andamento")
+
+    st.subheader("📤 Replicação do estado local")
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Alterações pendentes", get_estado_local().contar_pendentes())
+    col2.metric("Último envio", f"há {time.time() - replicador.replicado_em:.0f} s" if replicador.replicado_em else "—")
+    col3.metric("Última reconciliação", f"há {idade_status:.0f} s" if idade_status is not None else "—")
+    if replicador.erro is not None:
+        st.caption(f"Último erro: {replicador.erro}")
+
+    st.subheader("🧹 Compactação das abas de status")
+    st.caption("Mantém só a marcação mais recente de cada CPF/contrato; as repetidas vão para a aba historico.")
+    if st.button("Compactar abas agora"):
+        with st.spinner("Compactando abas..."):
+            st.session_state.relatorio_compactacao = compactar_abas_status()
+    if st.session_state.relatorio_compactacao:
+        df_compactacao = pd.DataFrame(st.session_state.relatorio_compactacao)
+        arquivadas = df_compactacao["Arquivadas"].sum()
+        economia = df_compactacao["KB antes"].sum() - df_compactacao["KB depois"].sum()
+        st.success(f"{arquivadas} linha(s) arquivada(s); cada leitura das abas baixa ~{economia:.1f} KB a menos.")
+        puladas = df_compactacao.loc[df_compactacao["Situação"] != "ok", "Aba"].tolist()
+        if puladas:
+            st.warning(f"Abas não compactadas (alteradas por outra sessão ou com erro): {', '.join(puladas)}. Veja a coluna Situação.")
+        st.dataframe(df_compactacao, use_container_width=True)
+
+    st.subheader("🗃️ Acertos de cache")
+    st.dataframe(instrumentacao.tabela_cache(), use_container_width=True)
+
+    col_log, col_zerar = st.columns(2)
+    col_log.download_button(
+        "📥 Baixar log estruturado (JSON Lines)",
+        data=instrumentacao.exportar_jsonl(),
+        file_name=f"diagnostico_{datetime.now():%Y%m%d_%H%M%S}.jsonl",
+        mime="application/x-ndjson",
+    )
+    if col_zerar.button("Zerar métricas"):
+        instrumentacao.zerar()
+        st.rerun()
+
+# Fecha o registro do rerun (páginas que chamam st.stop()/st.rerun() não chegam aqui e não são registradas)
+instrumentacao.finalizar_execucao(re.sub(r" \(\d+\)$", "", menu))  # sem o contador do rótulo do menu
@@ -0,0 +1,227 @@
+# Benchmarks das etapas do app.py com dados sintéticos e o cliente gspread em memória.
+# As funções e classes do app são carregadas sem executar as páginas do Streamlit.
+#
+# Uso: python benchmarks/bench_app.py --linhas 10000 100000 1000000 --saida resultados.json
+# Acima de LIMITE_XLSX linhas a base não cabe em .xlsx e a etapa de carga é pulada.
+import argparse
+import ast
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit.config
+import streamlit.logger
+
+from fake_gspread import ClienteFake
+from gerar_dados import LIMITE_XLSX, gerar_bases, gerar_lotes, gerar_status, salvar_xlsx
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app.py")
+NOME_ABA_ATIVOS = "Página1"
+
+
+def carregar_app(client):
+    # Executa só imports, funções, classes e constantes (nomes em maiúsculas) do app.py
+    with open(APP_PATH, encoding="utf-8") as f:
+        arvore = ast.parse(f.read())
+    corpo = [
+        no for no in arvore.body
+        if isinstance(no, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+        or (isinstance(no, ast.Assign) and all(isinstance(alvo, ast.Name) and alvo.id.isupper() for alvo in no.targets))
+    ]
+    app = {"__name__": "app_bench", "client": client}
+    exec(compile(ast.Module(body=corpo, type_ignores=[]), APP_PATH, "exec"), app)
+    # O cache do Streamlit é global ao processo e a chave não depende dos dados em disco:
+    # sem limpar, um tamanho reaproveitaria as bases do anterior
+    app["st"].cache_data.clear()
+    app["st"].cache_resource.clear()
+    return app
+
+
+def medir(funcao, repeticoes=1):
+    tempos = []
+    resultado = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return resultado, {"min_s": min(tempos), "mediana_s": statistics.median(tempos), "repeticoes": repeticoes}
+
+
+def novo_cliente(status):
+    abas = {NOME_ABA_ATIVOS: status["sheet1"], "tombados": status["tombados"], "aguardando": status["aguardando"]}
+    return ClienteFake({"consulta_ativa": {titulo: [list(l) for l in linhas] for titulo, linhas in abas.items()}})
+
+
+def executar(linhas, tamanho_lote, formatos, repeticoes, seed):
+    etapas = {}
+    novo_df, tomb_df = gerar_bases(linhas, seed)
+    status = gerar_status(novo_df, seed)
+    status_repetido = gerar_status(novo_df, seed, frac_repetidas=0.2)
+    lotes = gerar_lotes(novo_df, status, tamanho_lote, seed)
+    client = novo_cliente(status)
+    app = carregar_app(client)
+    os.makedirs(app["SNAPSHOT_DIR"], exist_ok=True)
+
+    novo_texto, tomb_texto = novo_df, tomb_df
+    memoria = {"texto_mb": (novo_df.memory_usage(deep=True).sum() + tomb_df.memory_usage(deep=True).sum()) / 2**20}
+
+    # Carga: XLSX -> snapshot (fria) e snapshot memory-mapped (morna), já no layout compacto
+    load = app["load_and_process_data"]
+    if linhas <= LIMITE_XLSX:
+        salvar_xlsx(app["DATA_DIR"], novo_df, tomb_df, lotes)
+        _, etapas["load_and_process_data.frio"] = medir(lambda: load(app["NOVO_PATH"], app["TOMB_PATH"]))
+        (novo_df, tomb_df), etapas["load_and_process_data.morno"] = medir(lambda: load(app["NOVO_PATH"], app["TOMB_PATH"]), repeticoes)
+    else:
+        etapas["load_and_process_data.frio"] = {"pulado": f"mais de {LIMITE_XLSX} linhas não cabem em .xlsx"}
+        (novo_df, tomb_df), etapas["compactar_bases"] = medir(lambda: app["compactar_bases"](novo_df.copy(), tomb_df.copy()))
+    memoria["compacta_mb"] = (novo_df.memory_usage(deep=True).sum() + tomb_df.memory_usage(deep=True).sum()) / 2**20
+
+    filtrado, etapas["get_filtered_df"] = medir(lambda: app["get_filtered_df"](novo_df), repeticoes)
+
+    IndiceBase = app["IndiceBase"]
+    indice_base, etapas["IndiceBase.base"] = medir(lambda: IndiceBase(novo_df), repeticoes)
+    indice_filtrado, etapas["IndiceBase.filtrada"] = medir(lambda: IndiceBase(filtrado), repeticoes)
+
+    cpfs_ativos, tombados, aguardando = app["ler_status_google"]()
+    versao_status = 1
+    calculate_counts = app["calculate_counts"]
+    argumentos = (filtrado, tomb_df, cpfs_ativos, tombados, aguardando, indice_filtrado, indice_base, 1, versao_status)
+    _, etapas["calculate_counts.calculo"] = medir(lambda: calculate_counts.__wrapped__(*argumentos), repeticoes)
+    calculate_counts.clear()
+    _, etapas["calculate_counts.frio"] = medir(lambda: calculate_counts(*argumentos))
+    contagens, etapas["calculate_counts.cache"] = medir(lambda: calculate_counts(*argumentos), repeticoes)
+
+    # Resumo: montagem, primeira sincronização com os conjuntos completos e sincronização de um delta de 1%
+    ResumoConsignante = app["ResumoConsignante"]
+    resumo, etapas["resumo.montagem"] = medir(lambda: ResumoConsignante(filtrado, tomb_df))
+    _, etapas["resumo.sincronizar_completo"] = medir(lambda: resumo.sincronizar(cpfs_ativos, tombados, aguardando, versao_status))
+    rng = np.random.default_rng(seed)
+    chaves = app["para_exibicao"](filtrado)[["Número CPF/CNPJ", "Número Contrato Crédito"]].astype(str).to_numpy()
+    delta = set(map(tuple, chaves[rng.choice(len(filtrado), size=max(1, len(filtrado) // 100), replace=False)]))
+    _, etapas["resumo.sincronizar_delta"] = medir(lambda: resumo.sincronizar(cpfs_ativos, tombados | delta, aguardando - delta, versao_status + 1))
+    _, etapas["resumo.tabela"] = medir(resumo.tabela, repeticoes)
+
+    # Nova versão da base com 2% dos contratos removidos e 1% dos consignantes trocados
+    removidos = rng.choice(len(novo_texto), size=len(novo_texto) // 50, replace=False)
+    novo_b = novo_texto.drop(index=novo_texto.index[removidos])
+    tomb_b = tomb_texto.copy()
+    trocados = tomb_b.index[rng.choice(len(tomb_b), size=max(1, len(tomb_b) // 100), replace=False)]
+    tomb_b.loc[trocados, "Empresa Consignante"] = "CONSIGNANTE TROCADA"
+    diferenca, etapas["atualizacao.diferenca_bases"] = medir(lambda: (
+        app["diferenca_bases"](novo_texto, novo_b, "Número CPF/CNPJ", "Número Contrato Crédito"),
+        app["diferenca_bases"](tomb_texto, tomb_b, "CPF Tomador", "Número Contrato"),
+    ))
+    etapas["atualizacao.diferenca_bases"].update({
+        "removidos": len(diferenca[0]["removidos"]), "alterados": len(diferenca[1]["alterados"]),
+    })
+    novo_b, tomb_b = app["compactar_bases"](novo_b, tomb_b)
+    filtrado_b = app["get_filtered_df"](novo_b)
+    _, etapas["atualizacao.resumo_herdado"] = medir(lambda: ResumoConsignante(filtrado_b, tomb_b, resumo).sincronizar(cpfs_ativos, tombados, aguardando, versao_status + 1))
+    _, etapas["atualizacao.resumo_do_zero"] = medir(lambda: ResumoConsignante(filtrado_b, tomb_b).sincronizar(cpfs_ativos, tombados, aguardando, versao_status + 1))
+    registros, etapas["resumo.registros_com_status"] = medir(resumo.registros_com_status, repeticoes)
+
+    # Lotes: a marcação grava no estado local (SQLite); a replicação para a planilha fake recém-populada
+    # é medida à parte, chamada diretamente em vez de esperar a thread do replicador
+    replicador = app["get_replicador"]()
+    for nome, processar, argumentos_lote in [
+        ("consulta", "processar_lote_consulta", lambda l: (l["CPF"].unique(), indice_base, cpfs_ativos)),
+        ("sisbr", "processar_lote_sisbr", lambda l: (l["CPF"], l["Contrato"], tombados, aguardando)),
+        ("tombado", "processar_lote_tombado", lambda l: (l["CPF"], l["Contrato"], tombados, aguardando)),
+    ]:
+        app["client"] = novo_cliente(status)
+        app["abrir_planilha"].clear()
+        app["obter_aba"].clear()
+        app["get_fila_escrita"].clear()
+        lote = lotes[nome]
+        log, etapas[f"lote_{nome}"] = medir(lambda: app[processar](*argumentos_lote(lote)))
+        replicadas, etapas[f"replicacao_{nome}"] = medir(replicador.replicar)
+        etapas[f"lote_{nome}"]["linhas"] = len(lote)
+        etapas[f"replicacao_{nome}"].update({"alteracoes": replicadas, "chamadas_sheets": dict(app["client"].chamadas)})
+
+    # Compactação das abas de status com 20% de marcações repetidas
+    app["client"] = novo_cliente(status_repetido)
+    app["abrir_planilha"].clear()
+    app["obter_aba"].clear()
+    relatorio, etapas["compactar_abas_status"] = medir(app["compactar_abas_status"])
+    etapas["compactar_abas_status"].update({
+        "arquivadas": sum(aba["Arquivadas"] for aba in relatorio),
+        "kb_antes": sum(aba["KB antes"] for aba in relatorio),
+        "kb_depois": sum(aba["KB depois"] for aba in relatorio),
+        "chamadas_sheets": dict(app["client"].chamadas),
+    })
+
+    # Exportações da relação analítica do Resumo (a maior tabela exportada pelo app)
+    exportacao = registros[['CPF', 'Contrato', 'CNPJ Empresa Consignante', 'Empresa Consignante', 'Consulta Ativa', 'Tombado', 'Aguardando']]
+    for formato in formatos:
+        if formato == "Excel" and len(exportacao) > LIMITE_XLSX:
+            etapas[f"exportacao.{formato}"] = {"pulado": f"mais de {LIMITE_XLSX} linhas não cabem em .xlsx"}
+            continue
+        dados, etapas[f"exportacao.{formato}"] = medir(lambda: app["gerar_exportacao"].__wrapped__(exportacao, formato, "Relação", "resumo_analitico", "bench"))
+        etapas[f"exportacao.{formato}"]["bytes"] = len(dados)
+
+    return {
+        "linhas": linhas,
+        "linhas_filtradas": len(filtrado),
+        "linhas_tombamento": len(tomb_df),
+        "memoria_bases": memoria,
+        "contagens": {"inconsistencias": contagens[0], "consulta_ativa": contagens[1], "aguardando": contagens[2], "tombado": contagens[3]},
+        "etapas": etapas,
+    }
+
+
+def ambiente():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(APP_PATH),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mede as etapas do app.py com dados sintéticos")
+    parser.add_argument("--linhas", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--lote", type=int, default=5_000)
+    parser.add_argument("--formatos", nargs="+", default=["Excel", "CSV", "Parquet"])
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--saida", help="arquivo JSON de saída (padrão: stdout)")
+    args = parser.parse_args()
+
+    # Fora do `streamlit run` o Streamlit avisa a cada chamada em cache; os avisos não interessam aqui.
+    # A configuração é lida antes, senão o nível definido por ela sobrescreve este.
+    streamlit.config.get_config_options()
+    streamlit.logger.set_log_level("error")
+    saida = os.path.abspath(args.saida) if args.saida else None
+
+    resultados = []
+    for linhas in args.linhas:
+        with tempfile.TemporaryDirectory() as pasta:
+            anterior = os.getcwd()
+            os.chdir(pasta)  # DATA_DIR do app é relativo ao diretório corrente
+            try:
+                resultados.append(executar(linhas, args.lote, args.formatos, args.repeticoes, args.seed))
+            finally:
+                os.chdir(anterior)
+        print(f"{linhas} linhas concluídas", file=sys.stderr)
+
+    relatorio = json.dumps({"ambiente": ambiente(), "resultados": resultados}, indent=2, ensure_ascii=False)
+    if saida:
+        with open(saida, "w", encoding="utf-8") as f:
+            f.write(relatorio)
+    else:
+        print(relatorio)
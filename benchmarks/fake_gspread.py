@@ -0,0 +1,113 @@
+# Substituto em memória do cliente gspread usado pelo app: guarda as abas como listas de
+# linhas e conta as chamadas feitas a cada método, para os benchmarks rodarem sem rede.
+import re
+from collections import Counter
+
+import gspread
+
+
+def _coluna(letras):
+    numero = 0
+    for letra in letras.upper():
+        numero = numero * 26 + ord(letra) - ord("A") + 1
+    return numero - 1
+
+
+class AbaFake:
+    def __init__(self, planilha, titulo, id_aba, valores=None):
+        self.spreadsheet = planilha
+        self.title = titulo
+        self.id = id_aba
+        self.valores = [list(linha) for linha in (valores or [])]
+
+    def _contar(self, metodo):
+        self.spreadsheet.client.chamadas[metodo] += 1
+
+    def append_row(self, linha, value_input_option="RAW", **kwargs):
+        self._contar("append_row")
+        self.valores.append(list(linha))
+
+    def append_rows(self, linhas, value_input_option="RAW", **kwargs):
+        self._contar("append_rows")
+        self.valores.extend(list(linha) for linha in linhas)
+
+    def get_all_values(self, **kwargs):
+        self._contar("get_all_values")
+        return [list(linha) for linha in self.valores]
+
+    def get_values(self, faixa=None, **kwargs):
+        self._contar("get_values")
+        return self.spreadsheet._recortar(self.valores, faixa)
+
+    def clear(self):
+        self._contar("clear")
+        self.valores = []
+
+
+class PlanilhaFake:
+    def __init__(self, client, nome, abas):
+        self.client = client
+        self.title = nome
+        self._abas = {}
+        for titulo, valores in abas.items():
+            self._abas[titulo] = AbaFake(self, titulo, len(self._abas), valores)
+
+    @property
+    def sheet1(self):
+        self.client.chamadas["sheet1"] += 1
+        return next(iter(self._abas.values()))
+
+    def worksheet(self, titulo):
+        self.client.chamadas["worksheet"] += 1
+        if titulo not in self._abas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self._abas[titulo]
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        self.client.chamadas["add_worksheet"] += 1
+        aba = AbaFake(self, title, len(self._abas))
+        self._abas[title] = aba
+        return aba
+
+    def _aba_por_id(self, id_aba):
+        return next(aba for aba in self._abas.values() if aba.id == id_aba)
+
+    @staticmethod
+    def _recortar(valores, faixa):
+        # Aceita faixas de colunas inteiras ("A:B"); sem faixa devolve tudo
+        if not faixa:
+            return [list(linha) for linha in valores]
+        inicio, _, fim = faixa.partition(":")
+        inicio, fim = _coluna(inicio), _coluna(fim or inicio) + 1
+        return [linha[inicio:fim] for linha in valores if linha[inicio:fim]]
+
+    def values_batch_get(self, ranges, params=None):
+        self.client.chamadas["values_batch_get"] += 1
+        resposta = []
+        for faixa in ranges:
+            titulo, _, colunas = faixa.partition("!")
+            titulo = re.sub(r"^'(.*)'$", r"\1", titulo).replace("''", "'")
+            valores = self._recortar(self._abas[titulo].valores, colunas)
+            resposta.append({"range": faixa, "majorDimension": "ROWS", "values": valores})
+        return {"spreadsheetId": self.title, "valueRanges": resposta}
+
+    def batch_update(self, body):
+        self.client.chamadas["batch_update"] += 1
+        for requisicao in body.get("requests", []):
+            faixa = requisicao["deleteDimension"]["range"]
+            aba = self._aba_por_id(faixa["sheetId"])
+            del aba.valores[faixa["startIndex"]:faixa["endIndex"]]
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+
+class ClienteFake:
+    # abas: {"consulta_ativa": {"Página1": [...], "tombados": [...], ...}}; a primeira aba faz o papel de sheet1
+    def __init__(self, planilhas):
+        self.chamadas = Counter()
+        self._planilhas = {nome: PlanilhaFake(self, nome, abas) for nome, abas in planilhas.items()}
+
+    def open(self, nome):
+        self.chamadas["open"] += 1
+        if nome not in self._planilhas:
+            raise gspread.exceptions.SpreadsheetNotFound(nome)
+        return self._planilhas[nome]
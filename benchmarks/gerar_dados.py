@@ -0,0 +1,145 @@
+# Gerador de dados sintéticos para os benchmarks: bases novoemprestimo/tombamento,
+# arquivos de lote e o conteúdo das abas da planilha consulta_ativa.
+#
+# Uso: python benchmarks/gerar_dados.py --linhas 100000 --destino data_bench
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+LIMITE_XLSX = 1_048_575  # linhas de dados que cabem numa aba .xlsx (1.048.576 com o cabeçalho)
+
+SUBMODALIDADE_CONSIGNADO = "CRÉDITO PESSOAL - COM CONSIGNAÇÃO EM FOLHA DE PAGAM."
+LINHAS_EXCLUIDAS = [140073, 138358, 141011, 101014, 137510]
+LINHAS_VALIDAS = [136001, 136002, 139450, 142210, 143005]
+PESOS_DV1 = np.arange(10, 1, -1)
+PESOS_DV2 = np.arange(11, 1, -1)
+
+
+def gerar_cpfs(n, rng):
+    # CPFs válidos (com dígitos verificadores), como texto de 11 dígitos
+    digitos = rng.integers(0, 10, size=(n, 11))
+    digitos[:, 0] = rng.integers(1, 10, size=n)  # evita CPFs com todos os dígitos repetidos
+    dv1 = (digitos[:, :9] @ PESOS_DV1 * 10) % 11 % 10
+    digitos[:, 9] = dv1
+    dv2 = (digitos[:, :10] @ PESOS_DV2 * 10) % 11 % 10
+    digitos[:, 10] = dv2
+    numeros = digitos @ (10 ** np.arange(10, -1, -1, dtype=np.int64))
+    return pd.Series(numeros.astype(str), dtype=object).str.zfill(11)
+
+
+def gerar_bases(linhas, seed=0, contratos_por_cpf=2.0, cobertura_tombamento=0.9):
+    # Retorna (novo_df, tomb_df) já no formato que o app obtém após formatar_documentos
+    rng = np.random.default_rng(seed)
+    n_cpfs = max(1, int(linhas / contratos_por_cpf))
+    cpfs = gerar_cpfs(n_cpfs, rng).drop_duplicates(ignore_index=True)
+    cpf_linha = cpfs.to_numpy()[rng.integers(0, len(cpfs), size=linhas)]
+    contratos = pd.Series(rng.permutation(linhas) + 10_000_000).astype(str).to_numpy()
+
+    # ~85% das linhas passam no filtro comum do app (get_filtered_df)
+    sorteio = rng.random(linhas)
+    submodalidade = np.where(sorteio < 0.95, SUBMODALIDADE_CONSIGNADO, "CRÉDITO PESSOAL - SEM CONSIGNAÇÃO")
+    criterio = np.where(rng.random(linhas) < 0.95, "FOLHA DE PAGAMENTO", "CONTA CORRENTE")
+    linha_credito = np.where(
+        rng.random(linhas) < 0.95,
+        rng.choice(LINHAS_VALIDAS, size=linhas),
+        rng.choice(LINHAS_EXCLUIDAS, size=linhas),
+    )
+
+    novo_df = pd.DataFrame({
+        "Número CPF/CNPJ": cpf_linha,
+        "Nome Cliente": pd.Series(rng.integers(0, 50_000, size=linhas)).map("CLIENTE {}".format).to_numpy(),
+        "Número Contrato Crédito": contratos,
+        "Submodalidade Bacen": submodalidade,
+        "Critério Débito": criterio,
+        "Código Linha Crédito": linha_credito,
+        "Quantidade Parcelas Abertas": rng.integers(1, 96, size=linhas),
+        "% Taxa Operação": np.round(rng.uniform(0.9, 2.5, size=linhas), 2),
+        "Nome Comercial": rng.choice(["CONSIGNADO PUBLICO", "CONSIGNADO PRIVADO", "CONSIGNADO INSS"], size=linhas),
+    })
+
+    # Tombamento cobre parte dos contratos; o restante vira inconsistência no app
+    no_tombamento = rng.random(linhas) < cobertura_tombamento
+    n_consignantes = max(1, min(2_000, linhas // 50))
+    consignante = rng.integers(0, n_consignantes, size=int(no_tombamento.sum()))
+    tomb_df = pd.DataFrame({
+        "CPF Tomador": cpf_linha[no_tombamento],
+        "Número Contrato": contratos[no_tombamento],
+        "CNPJ Empresa Consignante": pd.Series(consignante + 10_000_000_000_000).astype(str).to_numpy(),
+        "Empresa Consignante": pd.Series(consignante).map("CONSIGNANTE {}".format).to_numpy(),
+    })
+    return novo_df, tomb_df
+
+
+def gerar_status(novo_df, seed=0, frac_ativos=0.2, frac_tombados=0.3, frac_aguardando=0.1, frac_repetidas=0.0):
+    # Linhas das abas sheet1, tombados e aguardando (com cabeçalho), como o Sheets devolve.
+    # frac_repetidas acrescenta marcações repetidas mais antigas, como as abas acumulam com o tempo.
+    rng = np.random.default_rng(seed + 1)
+    timestamp = "2024-01-01 00:00:00"
+    cpfs = novo_df["Número CPF/CNPJ"].unique()
+    ativos = cpfs[rng.random(len(cpfs)) < frac_ativos]
+
+    sorteio = rng.random(len(novo_df))
+    chaves = novo_df[["Número CPF/CNPJ", "Número Contrato Crédito"]].to_numpy()
+    tomb = chaves[sorteio < frac_tombados]
+    aguard = chaves[(sorteio >= frac_tombados) & (sorteio < frac_tombados + frac_aguardando)]
+
+    abas = {
+        "sheet1": [["cpf", "timestamp"]] + [[cpf, timestamp] for cpf in ativos],
+        "tombados": [["cpf", "contrato", "timestamp"]] + [[cpf, contrato, timestamp] for cpf, contrato in tomb],
+        "aguardando": [["cpf", "contrato", "timestamp"]] + [[cpf, contrato, timestamp] for cpf, contrato in aguard],
+    }
+    for linhas in abas.values():
+        repetidas = rng.choice(np.arange(1, len(linhas)), size=int((len(linhas) - 1) * frac_repetidas), replace=False)
+        linhas.extend(linhas[i][:-1] + ["2023-06-01 00:00:00"] for i in repetidas)
+    return abas
+
+
+def gerar_lotes(novo_df, status, tamanho, seed=0):
+    # Lotes com a mistura que os usuários enviam: maioria válida, alguns inválidos e não encontrados
+    rng = np.random.default_rng(seed + 2)
+    tamanho = min(tamanho, len(novo_df))
+    amostra = novo_df.iloc[rng.choice(len(novo_df), size=tamanho, replace=False)]
+    cpfs = amostra["Número CPF/CNPJ"].to_numpy().copy()
+    contratos = amostra["Número Contrato Crédito"].to_numpy().copy()
+
+    invalidos = rng.random(tamanho) < 0.02
+    cpfs[invalidos] = [cpf[:10] + str((int(cpf[10]) + 1) % 10) for cpf in cpfs[invalidos]]
+    ausentes = rng.random(tamanho) < 0.03
+    cpfs[ausentes] = gerar_cpfs(int(ausentes.sum()), rng).to_numpy()
+
+    # Lote de tombado parte dos registros aguardando, como no fluxo real
+    aguard = status["aguardando"][1:]
+    escolhidos = rng.choice(len(aguard), size=min(tamanho, len(aguard)), replace=False) if aguard else []
+    lote_tombado = pd.DataFrame([aguard[i][:2] for i in escolhidos], columns=["CPF", "Contrato"])
+
+    return {
+        "consulta": pd.DataFrame({"CPF": cpfs}),
+        "sisbr": pd.DataFrame({"CPF": cpfs, "Contrato": contratos}),
+        "tombado": lote_tombado,
+    }
+
+
+def salvar_xlsx(destino, novo_df, tomb_df, lotes):
+    os.makedirs(destino, exist_ok=True)
+    if len(novo_df) > LIMITE_XLSX:
+        raise ValueError(f"{len(novo_df)} linhas não cabem em uma aba .xlsx (limite {LIMITE_XLSX})")
+    novo_df.to_excel(os.path.join(destino, "novoemprestimo.xlsx"), index=False)
+    tomb_df.to_excel(os.path.join(destino, "tombamento.xlsx"), index=False)
+    for nome, lote in lotes.items():
+        lote.to_excel(os.path.join(destino, f"lote_{nome}.xlsx"), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera bases e lotes sintéticos no formato do app")
+    parser.add_argument("--linhas", type=int, default=100_000)
+    parser.add_argument("--lote", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--destino", default="data_bench")
+    args = parser.parse_args()
+
+    novo_df, tomb_df = gerar_bases(args.linhas, args.seed)
+    status = gerar_status(novo_df, args.seed)
+    salvar_xlsx(args.destino, novo_df, tomb_df, gerar_lotes(novo_df, status, args.lote, args.seed))
+    print(f"Bases e lotes gravados em {args.destino}")